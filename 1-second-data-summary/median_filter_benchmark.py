@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+import h5py
+import numpy
+import scipy
+
+from one_second_data_summary_functions import MEDIAN_FILTER_SIZE, MEDIAN_FILTERS, PreparedSignals
+
+
+def _prepare(f, median_filter):
+    # a new instance for each run, as the prepared signals are kept
+    return PreparedSignals(f, None, None, median_filter).get_centered('current1')
+
+
+def _measure(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(*args)
+        time_elapsed = time.perf_counter() - start_time
+        best = time_elapsed if best is None else min(best, time_elapsed)
+    return best, result
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Throughput of preparing a channel with each median filter backend of the one-second summary, and whether it matches medfilt.')
+    parser.add_argument('--samples', type=int, default=50000 * 300, help='signal length, one channel of a 5-minute CLEAR file by default')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported')
+    parser.add_argument('--filters', nargs='+', choices=sorted(MEDIAN_FILTERS), help='backends to evaluate, all by default')
+    args = parser.parse_args()
+
+    # a CLEAR current without offset: a sine with noise and repeated values, as in the converted files
+    rs = numpy.random.RandomState(42)
+    t = numpy.arange(args.samples) / 50000
+    f = h5py.File('benchmark.hdf5', 'w', driver='core', backing_store=False)
+    dset = f.create_dataset('current1', data=numpy.rint(2000 * numpy.sin(2 * numpy.pi * 50 * t) + rs.normal(0, 40, args.samples)).astype('i2'))
+    dset.attrs['calibration_factor'] = 0.0041
+
+    print("Preparing {} samples with a window of {} (SciPy {})...".format(args.samples, MEDIAN_FILTER_SIZE, scipy.__version__))
+    reference = _prepare(f, 'medfilt')
+    print("{:<8} | {:>8} | {:>12} | {}".format('Filter', 'Time', 'Throughput', 'Identical'))
+    for name in args.filters or sorted(MEDIAN_FILTERS):
+        time_elapsed, result = _measure(_prepare, f, name, repeat=args.repeat)
+        print("{:<8} | {:>6.2f} s | {:>6.1f} MS/s | {}".format(
+            name,
+            time_elapsed,
+            args.samples / time_elapsed / 1e6,
+            'yes' if numpy.array_equal(result, reference) else 'NO',
+        ))
+
+
+if __name__ == '__main__':
+    __main__()
@@ -14,6 +14,8 @@ from one_second_data_summary_functions import compute_one_second_data_summary
 RESULTS = os.path.join(os.environ['RESULTS'], 'one-second-data-summary')
 LOCAL_PATH_PREFIX = os.environ['LOCAL_PATH_PREFIX']
 WORKER_PATH_PREFIX = os.environ['WORKER_PATH_PREFIX']
+COMPRESSION_PROFILE = os.environ.get('COMPRESSION_PROFILE', 'archive')
+MEDIAN_FILTER = os.environ.get('MEDIAN_FILTER', 'network')
 
 
 def update_results(results_q):
@@ -38,7 +40,7 @@ if __name__ == '__main__':
     print("Enqueueing {} folders...".format(total_jobs))
     q = Queue(connection=Redis())
     for folder in folders:
-        q.enqueue_call(compute_one_second_data_summary, args=(folder, WORKER_PATH_PREFIX, RESULTS), timeout=2**31 - 1)
+        q.enqueue_call(compute_one_second_data_summary, args=(folder, WORKER_PATH_PREFIX, RESULTS, COMPRESSION_PROFILE, MEDIAN_FILTER), timeout=2**31 - 1)
 
     results_q = Queue(connection=Redis(), name='results')
 
@@ -1,5 +1,6 @@
 import glob
 import os
+import sys
 import collections
 import datetime
 
@@ -17,9 +18,98 @@ import h5py
 from rq import Queue
 from rq import get_current_job
 
+# the compression profiles are shared with the converter, next to it in the repository or in the same directory when deployed
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data-collection'))
+from compression_profiles import COMPRESSION_PROFILES
+
+MEDIAN_FILTER_SIZE = 15
+MEDIAN_NETWORK_BLOCK_SIZE = 16384  # samples filtered at once, so that all rows of the network stay in the cache
+
+
+def _median_network(size):
+    """
+    Returns the comparators of Batcher's odd-even merge sort that the middle of size inputs depends on.
+    """
+    n = 1
+    while n < size:
+        n *= 2
+
+    comparators = []
+
+    def merge(lo, hi, r):
+        step = r * 2
+        if step < hi - lo:
+            merge(lo, hi, step)
+            merge(lo + r, hi, step)
+            comparators.extend((i, i + r) for i in range(lo + r, hi - r, step))
+        else:
+            comparators.append((lo, lo + r))
+
+    def sort(lo, hi):
+        if hi - lo >= 1:
+            mid = lo + (hi - lo) // 2
+            sort(lo, mid)
+            sort(mid + 1, hi)
+            merge(lo, hi, 1)
+
+    sort(0, n - 1)
+
+    # the missing inputs up to a power of two count as the largest values, their comparators never swap
+    needed = {size // 2}
+    median_comparators = []
+    for a, b in reversed([(a, b) for a, b in comparators if b < size]):
+        if a in needed or b in needed:
+            median_comparators.append((a, b))
+            needed.update((a, b))
+    return median_comparators[::-1]
+
+
+def network_median_filter(signal, size):
+    """
+    Median filter with zero padding at the edges, the same values as scipy.signal.medfilt.
+    Each window is reduced by a sorting network of element-wise minimum and maximum, which is
+    several times faster than medfilt on int16 samples.
+    """
+    half = size // 2
+    padded = np.zeros(len(signal) + 2 * half, dtype=signal.dtype)
+    padded[half:half + len(signal)] = signal
+    result = np.empty(len(signal), dtype=signal.dtype)
+
+    rows = [np.empty(MEDIAN_NETWORK_BLOCK_SIZE, dtype=signal.dtype) for _ in range(size)]
+    spare = np.empty(MEDIAN_NETWORK_BLOCK_SIZE, dtype=signal.dtype)
+    comparators = _median_network(size)
+    for start in range(0, len(signal), MEDIAN_NETWORK_BLOCK_SIZE):
+        length = min(MEDIAN_NETWORK_BLOCK_SIZE, len(signal) - start)
+        block = [row[:length] for row in rows]
+        low = spare[:length]
+        for i in range(size):
+            block[i][...] = padded[start + i:start + i + length]
+        for a, b in comparators:
+            np.minimum(block[a], block[b], out=low)
+            np.maximum(block[a], block[b], out=block[b])
+            block[a], low = low, block[a]
+        result[start:start + length] = block[half]
+    return result
+
+
+MEDIAN_FILTERS = {
+    # the reference
+    'medfilt': lambda signal, size: scipy.signal.medfilt(signal, size),
+    # the same values, several times faster on the int16 samples of a channel without offset,
+    # which are filtered before the calibration
+    'network': network_median_filter,
+}
+RAW_MEDIAN_FILTERS = ['network']  # backends that filter the samples of channels without offset before the calibration
+DEFAULT_MEDIAN_FILTER = 'network'
+
+
+def channel_names(f):
+    # converted files may contain groups with metadata next to the channels
+    return [name for name in f if isinstance(f[name], h5py.Dataset)]
+
 
 def calibrate_offset(f, average_frequency):
-    if 'voltage' not in list(f):
+    if 'voltage' not in channel_names(f):
         return np.zeros(f['voltage1'].shape), np.zeros(f['voltage1'].shape)
 
     length = len(f['voltage'])
@@ -37,7 +127,88 @@ def calibrate_offset(f, average_frequency):
     return offset, offset * 0.7
 
 
-def compute_rms(f, j, seconds_per_file, average_frequency, offset_voltage, offset_current, name):
+class PreparedSignals(object):
+    """
+    Reads, offset-corrects and calibrates each channel of a file once, and keeps the
+    median-filtered signals for all features computed from the file. The voltage is
+    filtered twice, with and without its mean, as the mains frequency is computed
+    from the signal with its mean.
+
+    Backends in RAW_MEDIAN_FILTERS filter the samples of channels without offset, e.g.,
+    of CLEAR, once before the calibration. The calibration and the removal of the mean
+    keep the order of the values in each window, so the median is the same sample; only
+    the windows at the edges of the centered signal, which reach into the zero padding,
+    are filtered again after the calibration.
+    """
+
+    def __init__(self, f, offset_voltage, offset_current, median_filter=DEFAULT_MEDIAN_FILTER):
+        self.f = f
+        self.median_filter = MEDIAN_FILTERS[median_filter]
+        self.filter_raw = median_filter in RAW_MEDIAN_FILTERS
+        self.offset_voltage = offset_voltage
+        self.offset_current = offset_current
+        self.names = channel_names(f)
+        self.centered = {}
+        self.filtered = {}
+
+    def _prepare(self, name):
+        samples = self.f[name][:]
+        signal = samples * 1.0
+        offset = None
+        # the offsets of files with three voltages are zero
+        if 'voltage' in name and self.offset_voltage is not None:
+            offset = self.offset_voltage
+        elif 'current' in name and self.offset_current is not None:
+            offset = self.offset_current
+        if offset is not None:
+            signal -= offset
+        signal = np.multiply(signal, self.f[name].attrs['calibration_factor'])
+
+        if self.filter_raw and (offset is None or not np.any(offset)):
+            self._prepare_raw(name, samples, signal)
+            return
+
+        if 'voltage' in name:
+            self.filtered[name] = self.median_filter(signal, MEDIAN_FILTER_SIZE)
+        signal -= np.mean(signal)
+        self.centered[name] = self.median_filter(signal, MEDIAN_FILTER_SIZE)
+
+    def _prepare_raw(self, name, samples, signal):
+        filtered = np.multiply(self.median_filter(samples, MEDIAN_FILTER_SIZE) * 1.0, self.f[name].attrs['calibration_factor'])
+        if 'voltage' in name:
+            self.filtered[name] = filtered
+
+        mean = np.mean(signal)
+        signal -= mean
+        centered = filtered - mean
+        # the zero padding is not zero before the mean is removed
+        edge = MEDIAN_FILTER_SIZE
+        if len(signal) <= 2 * edge:
+            centered = scipy.signal.medfilt(signal, MEDIAN_FILTER_SIZE)
+        else:
+            half = MEDIAN_FILTER_SIZE // 2
+            centered[:half] = scipy.signal.medfilt(signal[:edge], MEDIAN_FILTER_SIZE)[:half]
+            centered[-half:] = scipy.signal.medfilt(signal[-edge:], MEDIAN_FILTER_SIZE)[-half:]
+        self.centered[name] = centered
+
+    def get_centered(self, name):
+        """
+        Returns the calibrated signal of a channel without its mean, median-filtered.
+        """
+        if name not in self.centered:
+            self._prepare(name)
+        return self.centered[name]
+
+    def get_filtered(self, name):
+        """
+        Returns the calibrated signal of a voltage channel, median-filtered.
+        """
+        if name not in self.filtered:
+            self._prepare(name)
+        return self.filtered[name]
+
+
+def compute_rms(f, j, seconds_per_file, average_frequency, signals, name):
     """
     Root-Mean-Square'd values per second.
 
@@ -46,22 +217,15 @@ def compute_rms(f, j, seconds_per_file, average_frequency, offset_voltage, offse
     """
 
     rms = dict()
-    for name in list(f):
-        signal = f[name][:] * 1.0
-        if name == 'voltage' and offset_voltage is not None:
-            signal -= offset_voltage
-        elif 'current' in name and offset_current is not None:
-            signal -= offset_current
-        signal = np.multiply(signal, f[name].attrs['calibration_factor'])
-        signal -= np.mean(signal)
-        signal = scipy.signal.medfilt(signal, 15)
+    for name in signals.names:
+        signal = signals.get_centered(name)
 
         key = name.replace('current', 'current_rms').replace('voltage', 'voltage_rms')
         rms[key] = np.sqrt(np.mean(np.square(signal)[:seconds_per_file * int(average_frequency)].reshape(-1, int(average_frequency)), axis=1))
     return rms
 
 
-def compute_real_power(f, j, seconds_per_file, average_frequency, offset_voltage, offset_current):
+def compute_real_power(f, j, seconds_per_file, average_frequency, signals):
     """
     Real power is the average of instantaneous power.
 
@@ -71,27 +235,16 @@ def compute_real_power(f, j, seconds_per_file, average_frequency, offset_voltage
     that number of samples.
     """
 
-    cs = [n for n in list(f) if 'current' in n]
+    cs = [n for n in signals.names if 'current' in n]
     real_power = dict()
 
     for cs_i, _ in enumerate(cs):
-        if 'voltage' in list(f):
+        if 'voltage' in signals.names:
             voltage_name = 'voltage'
         else:
             voltage_name = 'voltage{}'.format(cs_i + 1)
-        voltage_signal = f[voltage_name][:] * 1.0
-        if offset_voltage is not None:
-            voltage_signal -= offset_voltage
-        voltage_signal *= f[voltage_name].attrs['calibration_factor']
-        voltage_signal -= np.mean(voltage_signal)
-        voltage_signal = scipy.signal.medfilt(voltage_signal, 15)
-
-        current_signal = f['current{}'.format(cs_i + 1)][:] * 1.0
-        if offset_current is not None:
-            current_signal -= offset_current
-        current_signal *= f['current{}'.format(cs_i + 1)].attrs['calibration_factor']
-        current_signal -= np.mean(current_signal)
-        current_signal = scipy.signal.medfilt(current_signal, 15)
+        voltage_signal = signals.get_centered(voltage_name)
+        current_signal = signals.get_centered('current{}'.format(cs_i + 1))
 
         real_power_name = 'real_power{}'.format(cs_i + 1)
 
@@ -106,11 +259,11 @@ def compute_apparent_power(f, j, seconds_per_file, values):
     Apparent power is the product of the voltage RMS and the current RMS.
     """
 
-    cs = [n for n in list(f) if 'current' in n]
+    cs = [n for n in channel_names(f) if 'current' in n]
     apparent_power = dict()
 
     for cs_i, _ in enumerate(cs):
-        if 'voltage' in list(f):
+        if 'voltage' in channel_names(f):
             voltage_name = 'voltage_rms'
         else:
             voltage_name = 'voltage_rms{}'.format(cs_i + 1)
@@ -128,7 +281,7 @@ def compute_power_factor(f, j, seconds_per_file, values):
     Power factor is the ratio of real power to apparent power.
     """
 
-    cs = [n for n in list(f) if 'current' in n]
+    cs = [n for n in channel_names(f) if 'current' in n]
     power_factor = dict()
 
     for cs_i, _ in enumerate(cs):
@@ -142,19 +295,18 @@ def compute_power_factor(f, j, seconds_per_file, values):
     return power_factor
 
 
-def compute_mains_frequency(f, j, seconds_per_file, frequency, average_frequency, offset_voltage):
+def compute_mains_frequency(f, j, seconds_per_file, frequency, average_frequency, signals):
     """
     Mains frequency is calculated by counting zero-crossings in the voltage.
 
     To get a cleaner value, we take the average across all phases.
     """
 
-    vs = [n for n in list(f) if 'voltage' in n]
+    vs = [n for n in signals.names if 'voltage' in n]
     mains_freq = np.zeros((len(vs), seconds_per_file))
 
     for cs_i, name in enumerate(vs):
-        voltage_signal = (f[name][:] * 1.0 - offset_voltage) * f[name].attrs['calibration_factor']
-        voltage_signal = scipy.signal.medfilt(voltage_signal, 15)
+        voltage_signal = signals.get_filtered(name)
 
         for i, j in enumerate(range(0, len(voltage_signal), frequency)):
             voltage_slice = voltage_signal[j:(j + frequency)]
@@ -212,7 +364,7 @@ def compute_average_frequency(start_file, end_file, files_path, files_length, se
     return duration / (end_timestamp - start_timestamp).total_seconds() * frequency
 
 
-def make_hdf5_file(hdf5_file, year, month, day, name, values, delay_after_midnight, frequency, average_frequency):
+def make_hdf5_file(hdf5_file, year, month, day, name, values, delay_after_midnight, frequency, average_frequency, compression_profile='archive'):
     with h5py.File(hdf5_file, 'w', driver='core') as f:
         f.attrs.create('year', year, dtype='uint32')
         f.attrs.create('month', month, dtype='uint32')
@@ -229,10 +381,7 @@ def make_hdf5_file(hdf5_file, year, month, day, name, values, delay_after_midnig
                 data=v,
                 shape=v.shape,
                 dtype='f',
-                fletcher32=True,
-                compression='gzip',
-                compression_opts=9,
-                shuffle=True,
+                **COMPRESSION_PROFILES[compression_profile]
             )
 
 
@@ -275,7 +424,7 @@ def make_plots(hdf5_file, year, month, day, name, delay_after_midnight):
     plt.close()
 
 
-def compute_one_second_data_summary(folder, path_prefix, results_folder):
+def compute_one_second_data_summary(folder, path_prefix, results_folder, compression_profile='archive', median_filter=DEFAULT_MEDIAN_FILTER):
     dataset_folder = folder.split('/')[0]
 
     files_path = os.path.expanduser(os.path.join(path_prefix, folder, '*.hdf5'))
@@ -295,7 +444,7 @@ def compute_one_second_data_summary(folder, path_prefix, results_folder):
         month = f.attrs['month']
         day = f.attrs['day']
         frequency = int(f.attrs['frequency'])
-        length = len(f[list(f)[0]])
+        length = len(f[channel_names(f)[0]])
         seconds_per_file = length // frequency
         delay_after_midnight = int(f.attrs['hours']) * 60 * 60 + int(f.attrs['minutes']) * 60 + round(int(f.attrs['seconds']) + int(f.attrs['microseconds']) * 1e-6)
 
@@ -314,16 +463,17 @@ def compute_one_second_data_summary(folder, path_prefix, results_folder):
         try:
             with h5py.File(file, 'r', driver='core') as f:
                 offset_voltage, offset_current = calibrate_offset(f, average_frequency)
+                signals = PreparedSignals(f, offset_voltage, offset_current, median_filter)
 
                 if folder == 'BLOND-50/2016-10-18/clear' and f.attrs['sequence'] == 0:
                     # CLEAR had a brief interruption that day.
                     # We need to create a gap to align the next data file correctly.
                     j += 8367
 
-                for k, v in compute_rms(f, j, seconds_per_file, average_frequency, offset_voltage, offset_current, name).items():
+                for k, v in compute_rms(f, j, seconds_per_file, average_frequency, signals, name).items():
                     values[k][j:j + seconds_per_file] = v
 
-                for k, v in compute_real_power(f, j, seconds_per_file, average_frequency, offset_voltage, offset_current).items():
+                for k, v in compute_real_power(f, j, seconds_per_file, average_frequency, signals).items():
                     values[k][j:j + seconds_per_file] = v
 
                 for k, v in compute_apparent_power(f, j, seconds_per_file, values).items():
@@ -332,7 +482,7 @@ def compute_one_second_data_summary(folder, path_prefix, results_folder):
                 for k, v in compute_power_factor(f, j, seconds_per_file, values).items():
                     values[k][j:j + seconds_per_file] = v
 
-                values['mains_frequency'][j:j + seconds_per_file] = compute_mains_frequency(f, j, seconds_per_file, frequency, average_frequency, offset_voltage)
+                values['mains_frequency'][j:j + seconds_per_file] = compute_mains_frequency(f, j, seconds_per_file, frequency, average_frequency, signals)
         except IOError:
             pass
         j += seconds_per_file
@@ -342,7 +492,7 @@ def compute_one_second_data_summary(folder, path_prefix, results_folder):
     os.makedirs(folder, exist_ok=True)
     hdf5_file = os.path.join(folder, filename)
 
-    make_hdf5_file(hdf5_file, year, month, day, name, values, delay_after_midnight, frequency, average_frequency)
+    make_hdf5_file(hdf5_file, year, month, day, name, values, delay_after_midnight, frequency, average_frequency, compression_profile)
     make_plots(hdf5_file, year, month, day, name, delay_after_midnight)
 
     job = get_current_job()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import warnings
+
+import numpy
+import numpy as np
+import scipy
+import scipy.signal
+import h5py
+
+from one_second_data_summary_functions import *
+
+# %%
+# every median filter backend must give the values of medfilt, including its zero padding at the edges
+random = np.random.RandomState(42)
+signals = []
+for length in list(range(1, 64)) + [1000, 65536 + 7]:
+    signals.append(random.normal(0, 1, length))
+    signals.append(random.randint(-3, 3, length) * 1.0)  # many equal values
+    signals.append(np.abs(random.normal(0, 1, length)) + 1)  # padding below all values
+    signals.append(-np.abs(random.normal(0, 1, length)) - 1)  # padding above all values
+    signals.append(random.randint(-2**15, 2**15, length).astype('i2'))  # samples before the calibration
+
+with warnings.catch_warnings():
+    # medfilt warns about signals shorter than the window
+    warnings.simplefilter('ignore')
+    for name, median_filter in MEDIAN_FILTERS.items():
+        for i, s in enumerate(signals):
+            expected = scipy.signal.medfilt(s, MEDIAN_FILTER_SIZE)
+            if s.dtype.kind == 'i':
+                # medfilt only keeps the dtype of float signals
+                expected = scipy.signal.medfilt(s * 1.0, MEDIAN_FILTER_SIZE).astype(s.dtype)
+            result = median_filter(s, MEDIAN_FILTER_SIZE)
+            assert result.dtype == expected.dtype, (name, i)
+            assert np.array_equal(result, expected), (name, i, len(s))
+
+print('SUCCESS')
+
+# %%
+# the prepared signals, and so all features, do not depend on the backend,
+# also where the samples are filtered before the calibration
+def make_file(name, channels, frequency, seconds):
+    f = h5py.File('{}.hdf5'.format(name), 'w', driver='core', backing_store=False)
+    t = np.arange(frequency * seconds) / frequency
+    for i, channel in enumerate(channels):
+        amplitude = 15000 if 'voltage' in channel else 2000
+        values = amplitude * np.sin(2 * np.pi * 50 * t + i) + random.normal(0, 40, len(t))
+        dset = f.create_dataset(channel, data=values.astype('i2'))
+        dset.attrs['calibration_factor'] = 0.0229 if 'voltage' in channel else 0.0041
+    return f
+
+files = [
+    make_file('medal', ['voltage'] + ['current{}'.format(i + 1) for i in range(6)], 6400, 5),
+    make_file('clear', ['voltage1', 'voltage2', 'voltage3', 'current1', 'current2', 'current3'], 50000, 5),
+]
+for f in files:
+    length = len(f['current1'])
+    if 'voltage' in channel_names(f):
+        offset_voltage = random.normal(0, 10, length)
+    else:
+        # files with three voltages have no offset
+        offset_voltage = np.zeros(length)
+    signals = {name: PreparedSignals(f, offset_voltage, offset_voltage * 0.7, name) for name in MEDIAN_FILTERS}
+    expected = signals['medfilt']
+    for name, s in signals.items():
+        for channel in channel_names(f):
+            assert np.array_equal(s.get_centered(channel), expected.get_centered(channel)), (name, channel)
+            if 'voltage' in channel:
+                assert np.array_equal(s.get_filtered(channel), expected.get_filtered(channel)), (name, channel)
+        rms = compute_rms(f, 0, 5, 6400, s, 'test')
+        expected_rms = compute_rms(f, 0, 5, 6400, expected, 'test')
+        for k in expected_rms:
+            assert np.array_equal(rms[k], expected_rms[k]), (name, k)
+    f.close()
+
+print('SUCCESS')
@@ -0,0 +1,13 @@
+# HDF5 dataset options of the converted files and the one-second summary, shared by the tools that write them
+
+COMPRESSION_PROFILES = {
+    # the layout of the published dataset, slowest to write
+    'archive': dict(fletcher32=True, compression='gzip', compression_opts=9, shuffle=True),
+    # fast conversion at ingest, still readable by any HDF5 library
+    'ingest': dict(fletcher32=True, compression='gzip', compression_opts=1, shuffle=True),
+    # fastest compression, but LZF is only available with h5py or its filter plugin
+    'lzf': dict(fletcher32=True, compression='lzf', shuffle=True),
+    # checksummed chunks without compression
+    'none': dict(fletcher32=True),
+}
+DEFAULT_COMPRESSION_PROFILE = 'archive'
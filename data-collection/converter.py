@@ -1,16 +1,264 @@
 #!/usr/bin/env python3
 
+import argparse
+import concurrent.futures
 import h5py
 import numpy
 import os
 import re
+import struct
 import sys
 import time
 import traceback
+import zlib
+
+from compression_profiles import COMPRESSION_PROFILES, DEFAULT_COMPRESSION_PROFILE
+from logwriter import get_writer
 
 DESTINATION = os.path.expanduser('/energy-daq/storage')
+LOG_FILE = 'files/converter.log'
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text or json
+LOG_MAX_BYTES = 16 * 1024 * 1024  # rotated by the converter, as logrotate does not cover it
 CALIBRATION_FACTOR_ATTR = 'calibration_factor'
 REMOVED_OFFSET_ATTR = 'removed_offset'
+DROPPED_PACKETS_ATTR = 'dropped_packets'
+TRIGGER_GAPS_DSET = 'metadata/trigger_gaps'
+AGGREGATES_GROUP = 'aggregates'
+DECODE_BLOCK_SIZE = 16384  # packets, small enough for the decoding temporaries to stay in the CPU cache
+STREAMING_BLOCK_SIZE = 64 * 1024 * 1024  # bytes of input data held in memory at once in streaming mode
+STREAMING_CHUNK_CACHE_SIZE = 1024 * 1024  # bytes of HDF5 chunk cache per dataset in streaming mode
+
+MAINS_FREQUENCY = 50  # Hz
+CHUNK_LAYOUTS = {
+    # chunk length guessed by h5py from the dataset size
+    'auto': None,
+    # mains cycles per chunk, for reading short windows of the waveform
+    'cycle': 1,
+    'cycles10': 10,
+    'second': MAINS_FREQUENCY,
+}
+DEFAULT_CHUNK_LAYOUT = 'auto'
+
+
+def chunk_shape(chunk_layout, frequency, samples_count):
+    """
+    Returns the chunk shape of a channel for one of CHUNK_LAYOUTS, or None to let h5py guess it.
+    """
+    cycles = CHUNK_LAYOUTS[chunk_layout]
+    if cycles is None:
+        return None
+    return (max(min(int(frequency) * cycles // MAINS_FREQUENCY, samples_count), 1),)
+
+
+def _transpose_bits(x):
+    """
+    Transposes the 8x8 bit matrix in each uint64 of x, i.e., bit c of byte k
+    becomes bit k of byte c (Hacker's Delight, 7-3).
+    """
+    t = (x ^ (x >> numpy.uint64(7))) & numpy.uint64(0x00AA00AA00AA00AA)
+    x = x ^ t ^ (t << numpy.uint64(7))
+    t = (x ^ (x >> numpy.uint64(14))) & numpy.uint64(0x0000CCCC0000CCCC)
+    x = x ^ t ^ (t << numpy.uint64(14))
+    t = (x ^ (x >> numpy.uint64(28))) & numpy.uint64(0x00000000F0F0F0F0)
+    x = x ^ t ^ (t << numpy.uint64(28))
+    return x
+
+
+def _fletcher32(data):
+    """
+    Computes the checksum of the HDF5 fletcher32 filter (H5_checksum_fletcher32).
+
+    HDF5 sums big-endian 16-bit words and reduces both sums modulo 65535 with
+    end-around carry, which never overflows. Hence the result is equal to the
+    closed form of the sums reduced to the range [1, 65535], or 0 if all words are 0.
+    """
+    if len(data) % 2:
+        data += b'\x00'
+    words = numpy.frombuffer(data, dtype='>u2').astype('int64')
+    sum1 = int(numpy.sum(words))
+    sum2 = len(words) * sum1 - int(numpy.dot(numpy.arange(len(words), dtype='int64'), words))
+    sum1 = (sum1 - 1) % 65535 + 1 if sum1 else 0
+    sum2 = (sum2 - 1) % 65535 + 1 if sum2 else 0
+    return (sum2 << 16) | sum1
+
+
+def read_trigger_gaps(f):
+    """
+    Returns the trigger gap index of a converted file, or None if the file was
+    converted without one. Each gap holds the index of the first sample after
+    the gap and the number of packets missing before it.
+    """
+    if TRIGGER_GAPS_DSET not in f:
+        return None
+    return f[TRIGGER_GAPS_DSET][:]
+
+
+class TriggerGapScanner(object):
+    """
+    Finds discontinuities of the 16-bit trigger counter, which increments by one
+    per packet and wraps around. More than 65535 consecutive missing packets
+    cannot be told apart from fewer ones.
+    """
+
+    DTYPE = numpy.dtype([('index', '<u8'), ('missing', '<u2')])
+
+    def __init__(self):
+        self.previous = None
+        self.gaps = []
+
+    def scan(self, start, triggers):
+        if self.previous is not None:
+            triggers = numpy.concatenate(([self.previous], triggers))
+            start -= 1
+        self.previous = triggers[-1]
+
+        # uint16 arithmetic handles the wraparound
+        missing = numpy.diff(triggers.astype('<u2')) - numpy.uint16(1)
+        indices = numpy.flatnonzero(missing)
+
+        gaps = numpy.empty(len(indices), dtype=self.DTYPE)
+        gaps['index'] = indices + start + 1
+        gaps['missing'] = missing[indices]
+        self.gaps.append(gaps)
+
+    def write(self, output_file):
+        gaps = numpy.concatenate(self.gaps) if self.gaps else numpy.empty(0, dtype=self.DTYPE)
+        output_file.create_dataset(TRIGGER_GAPS_DSET, data=gaps)
+        output_file.attrs.create(DROPPED_PACKETS_ATTR, numpy.sum(gaps['missing'], dtype='uint64'), dtype='uint64')
+
+
+def read_second_aggregates(f, name):
+    """
+    Returns the per-second aggregates of a channel, or None if the file was
+    converted without them. The values are in ADC units, i.e., not calibrated.
+    """
+    path = '{}/{}'.format(AGGREGATES_GROUP, name)
+    if path not in f:
+        return None
+    return f[path][:]
+
+
+class SecondAggregator(object):
+    """
+    Accumulates per-second statistics of all channels from blocks of samples,
+    which do not have to be aligned to seconds. Zero crossings are counted
+    from negative to non-negative samples in the second of the latter sample.
+    """
+
+    DTYPE = numpy.dtype([
+        ('count', '<u4'),
+        ('sum', '<i8'),
+        ('sum_of_squares', '<i8'),
+        ('min', '<i2'),
+        ('max', '<i2'),
+        ('zero_crossings', '<u4'),
+    ])
+    SLICE_LENGTH = 1024 * 1024  # samples, bounds the memory of the int64 temporaries
+
+    def __init__(self, names, samples_count, frequency):
+        self.names = names
+        self.frequency = frequency
+        self.tables = numpy.zeros((len(names), -(-samples_count // frequency)), dtype=self.DTYPE)
+        self.tables['min'] = numpy.iinfo('<i2').max
+        self.tables['max'] = numpy.iinfo('<i2').min
+        self.previous = [None] * len(names)
+
+    def update(self, start, channels):
+        for i, values in enumerate(channels):
+            for offset in range(0, len(values), self.SLICE_LENGTH):
+                self._update(i, start + offset, values[offset:offset + self.SLICE_LENGTH])
+
+    def _update(self, channel, start, values):
+        first_second = start // self.frequency
+        last_second = (start + len(values) - 1) // self.frequency
+        seconds = numpy.arange(first_second, last_second + 1)
+        # the start of each second within values
+        indices = numpy.maximum(seconds * self.frequency - start, 0)
+
+        table = self.tables[channel]
+        wide = values.astype('int64')
+        table['count'][seconds] += numpy.diff(numpy.append(indices, len(values))).astype('<u4')
+        table['sum'][seconds] += numpy.add.reduceat(wide, indices)
+        table['sum_of_squares'][seconds] += numpy.add.reduceat(wide * wide, indices)
+        table['min'][seconds] = numpy.minimum(table['min'][seconds], numpy.minimum.reduceat(values, indices))
+        table['max'][seconds] = numpy.maximum(table['max'][seconds], numpy.maximum.reduceat(values, indices))
+
+        negative = values < 0
+        crossings = numpy.empty(len(values), dtype='<u4')
+        crossings[0] = self.previous[channel] is not None and self.previous[channel] < 0 and not negative[0]
+        crossings[1:] = negative[:-1] & ~negative[1:]
+        table['zero_crossings'][seconds] += numpy.add.reduceat(crossings, indices)
+        self.previous[channel] = values[-1]
+
+    def write(self, output_file):
+        for name, table in zip(self.names, self.tables):
+            output_file.create_dataset('{}/{}'.format(AGGREGATES_GROUP, name), data=table)
+
+
+class ChunkCompressor(object):
+    """
+    Applies the filter pipeline of a chunked dataset to whole chunks, so that
+    they can be compressed outside of HDF5 and stored with direct chunk writes.
+    """
+
+    SUPPORTED_FILTERS = [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_FLETCHER32]
+
+    def __init__(self, dset):
+        plist = dset.id.get_create_plist()
+        self.itemsize = dset.dtype.itemsize
+        self.chunk_length = dset.chunks[0]
+        self.filters = [plist.get_filter(i)[:3] for i in range(plist.get_nfilters())]
+
+    @classmethod
+    def supports(cls, dset):
+        if dset.chunks is None or len(dset.chunks) != 1:
+            return False
+        plist = dset.id.get_create_plist()
+        return all(plist.get_filter(i)[0] in cls.SUPPORTED_FILTERS for i in range(plist.get_nfilters()))
+
+    def compress(self, values):
+        if len(values) < self.chunk_length:
+            # the last chunk is stored in full, beyond the dataset it holds the fill value
+            values = numpy.concatenate((values, numpy.zeros(self.chunk_length - len(values), dtype=values.dtype)))
+
+        data = values.tobytes()
+        for code, _, options in self.filters:
+            if code == h5py.h5z.FILTER_SHUFFLE:
+                data = numpy.frombuffer(data, dtype='B').reshape(-1, self.itemsize).T.tobytes()
+            elif code == h5py.h5z.FILTER_DEFLATE:
+                data = zlib.compress(data, options[0])
+            elif code == h5py.h5z.FILTER_FLETCHER32:
+                data += struct.pack('<I', _fletcher32(data))
+        return data
+
+
+class ChunkWriter(object):
+    """
+    Compresses the chunks of all datasets in a thread pool and stores them with
+    direct chunk writes. zlib releases the GIL, so the compression of all
+    channels scales with the number of threads.
+    """
+
+    def __init__(self, dsets, threads):
+        self.dsets = dsets
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.compressors = [ChunkCompressor(dset) for dset in dsets]
+
+    def close(self):
+        self.executor.shutdown()
+
+    def write(self, start, channels):
+        """
+        Writes the channels beginning at sample start, which has to be the first sample of a chunk.
+        """
+        tasks = []
+        for dset, compressor, values in zip(self.dsets, self.compressors, channels):
+            for offset in range(0, len(values), compressor.chunk_length):
+                chunk = values[offset:offset + compressor.chunk_length]
+                tasks.append((dset, start + offset, self.executor.submit(compressor.compress, chunk)))
+
+        for dset, offset, task in tasks:
+            dset.id.write_direct_chunk((offset,), task.result())
 
 
 class MicroControllerDevice(object):
@@ -45,6 +293,15 @@ class MicroControllerDevice(object):
         6: CALIBRATION_5A,
     }
 
+    # ADC channels 1-7, channel 0 is empty and free-floating
+    CHANNELS = ['current1', 'current2', 'current3', 'current4', 'current5', 'current6', 'voltage']
+
+    # the voltage offset is its mean, which requires a full pass over the data
+    REQUIRES_CHANNEL_SUMS = True
+
+    # the sample bytes as one little-endian 8-byte and one 4-byte word, bit c of each byte belongs to ADC channel c
+    SAMPLE_WORDS = numpy.dtype({'names': ['low', 'high'], 'formats': ['<u8', '<u4'], 'offsets': [2, 10], 'itemsize': 14})
+
     def read_data(self, raw_data):
         dtypes = [
             ('trigger', '>u2'),
@@ -63,37 +320,44 @@ class MicroControllerDevice(object):
         ]
         return numpy.frombuffer(raw_data, dtype=dtypes)
 
-    def parse_channels(self, data, output_file, **default_dataset_options):
-        # channel 0 is empty and free-floating
-
-        for channel_id in [1, 2, 3, 4, 5, 6]:
-            name = 'current{}'.format(channel_id)
+    def decode_channels(self, data):
+        """
+        Deinterleaves the bit-planes of all channels in a single pass.
+
+        Returns a contiguous (channels x samples) int16 block in the order of CHANNELS.
+        Transposing the bit matrices of sample bytes 2-9 and 10-13 yields the lower
+        8 and the upper 4 bits of each channel as one byte per channel.
+        """
+        channels = numpy.empty((len(self.CHANNELS), len(data)), dtype='<i2')
+        words = data.view(self.SAMPLE_WORDS)
+        for start in range(0, len(data), DECODE_BLOCK_SIZE):
+            end = start + DECODE_BLOCK_SIZE
+            low = _transpose_bits(words['low'][start:end].astype('<u8')).view('B').reshape(-1, 8)
+            high = _transpose_bits(words['high'][start:end].astype('<u8')).view('B').reshape(-1, 8)
+            block = channels[:, start:end]
+            block[:] = high[:, 1:8].T
+            block <<= 8
+            block |= low[:, 1:8].T
+        return channels
+
+    def channel_offsets(self, channel_sums, samples_count):
+        """
+        Returns the offset removed from each channel, the currents have a fixed
+        DC-offset and the voltage is centered around its mean.
+        """
+        return [2500, 2500, 2500, 2500, 2500, 2500, int(channel_sums[6] / samples_count)]
+
+    def create_datasets(self, output_file, offsets, **default_dataset_options):
+        dsets = []
+        for channel_id, (name, offset) in enumerate(zip(self.CHANNELS, offsets), 1):
             dset = output_file.create_dataset(name, **default_dataset_options)
-            self._parse_current(data, dset, channel_id)
-
-        name = 'voltage'
-        dset = output_file.create_dataset(name, **default_dataset_options)
-        self._parse_voltage(data, dset, 7)
-
-    def _parse_voltage(self, data, dset, channel_id):
-        dset[:] = self._extract_channel(data, channel_id)
-        mean_voltage_offset = int(numpy.mean(dset[:]))
-        dset[:] -= mean_voltage_offset
-        dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_VOLTAGE, dtype='f8')
-        dset.attrs.create(REMOVED_OFFSET_ATTR, mean_voltage_offset, dtype='int16')
-
-    def _parse_current(self, data, dset, channel_id):
-        dset[:] = self._extract_channel(data, channel_id)
-        dset[:] -= 2500
-        dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_CURRENT[channel_id], dtype='f8')
-        dset.attrs.create(REMOVED_OFFSET_ATTR, 2500, dtype='int16')
-
-    def _extract_channel(self, data, channel_id):
-        result = data.view('B').reshape(len(data), 14)[:, 2:14].astype('u2')
-        result &= 1 << channel_id
-        result >>= channel_id
-        result *= numpy.array([1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048], dtype='u2')
-        return numpy.sum(result, axis=1)
+            if name == 'voltage':
+                dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_VOLTAGE, dtype='f8')
+            else:
+                dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_CURRENT[channel_id], dtype='f8')
+            dset.attrs.create(REMOVED_OFFSET_ATTR, offset, dtype='int16')
+            dsets.append(dset)
+        return dsets
 
 
 class FPGADevice(object):
@@ -118,6 +382,10 @@ class FPGADevice(object):
     CALIBRATION_VOLTAGE = 0.011170775  # 225Vrms => 317.25Vpeak == 28400 => 28400 / 317.25
     CALIBRATION_CURRENT = 0.000962500  # 3 turns, 50Arms, calibrated on 2016-09-14 with kettle: 7.15Arms + 0.19Arms baseline
 
+    CHANNELS = ['voltage1', 'current1', 'voltage2', 'current2', 'voltage3', 'current3']
+
+    REQUIRES_CHANNEL_SUMS = False
+
     def read_data(self, raw_data):
         dtypes = [
             ('trigger', '<u2'),
@@ -127,22 +395,62 @@ class FPGADevice(object):
         ]
         return numpy.frombuffer(raw_data, dtype=dtypes)
 
-    def parse_channels(self, data, output_file, **default_dataset_options):
-        for phase_id in [1, 2, 3]:
-            name = 'voltage{}'.format(phase_id)
-            dset = output_file.create_dataset(name, data=data[name], **default_dataset_options)
-            dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_VOLTAGE, dtype='f8')
-
-            name = 'current{}'.format(phase_id)
-            dset = output_file.create_dataset(name, data=data[name], **default_dataset_options)
-            dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_CURRENT, dtype='f8')
+    def decode_channels(self, data):
+        """
+        Deinterleaves the ADC words of all channels in a single pass.
+
+        Returns a contiguous (channels x samples) int16 block in the order of CHANNELS.
+        """
+        words = data.view('<i2').reshape(len(data), 7)
+        channels = numpy.empty((len(self.CHANNELS), len(data)), dtype='<i2')
+        for start in range(0, len(data), DECODE_BLOCK_SIZE):
+            end = start + DECODE_BLOCK_SIZE
+            channels[:, start:end] = words[start:end, 1:7].T
+        return channels
+
+    def channel_offsets(self, channel_sums, samples_count):
+        # the ADCs are bipolar, no offset is removed
+        return [None] * len(self.CHANNELS)
+
+    def create_datasets(self, output_file, offsets, **default_dataset_options):
+        dsets = []
+        for name in self.CHANNELS:
+            dset = output_file.create_dataset(name, **default_dataset_options)
+            if 'voltage' in name:
+                dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_VOLTAGE, dtype='f8')
+            else:
+                dset.attrs.create(CALIBRATION_FACTOR_ATTR, self.CALIBRATION_CURRENT, dtype='f8')
+            dsets.append(dset)
+        return dsets
 
 
 class Converter(object):
 
-    def __init__(self, input_file, frequency, output_dir=None):
+    def __init__(self, input_file, frequency, output_dir=None, block_size=None, compression_profile=DEFAULT_COMPRESSION_PROFILE, compression_threads=None, chunk_layout=DEFAULT_CHUNK_LAYOUT):
+        """
+        By default the whole input file is converted in memory. If block_size
+        is given, the input is streamed in blocks of at most block_size bytes
+        and the output file is written incrementally, so that the peak memory
+        usage is independent of the file length.
+
+        The datasets are compressed according to one of COMPRESSION_PROFILES.
+        If compression_threads is given, the chunks are compressed in a thread
+        pool of that size and stored with direct chunk writes, unless the profile
+        uses a filter that is not supported by ChunkCompressor.
+
+        The chunks are aligned to mains cycles at the nominal frequency according to one of CHUNK_LAYOUTS.
+        """
+        if compression_profile not in COMPRESSION_PROFILES:
+            raise ValueError('Unknown compression profile: {}'.format(compression_profile))
+        if chunk_layout not in CHUNK_LAYOUTS:
+            raise ValueError('Unknown chunk layout: {}'.format(chunk_layout))
+
         self.input_file = input_file
         self.frequency = frequency
+        self.block_size = block_size
+        self.compression_profile = compression_profile
+        self.compression_threads = compression_threads
+        self.chunk_layout = chunk_layout
         self.device = MicroControllerDevice() if 'medal' in input_file else FPGADevice()
 
         g = self._parse_filename()
@@ -155,7 +463,6 @@ class Converter(object):
 
         _log("Converting {} to {}...".format(os.path.relpath(self.input_file, os.getcwd()), os.path.relpath(self.output_file, os.getcwd())))
 
-        self._read_data()
         self._parse_data()
 
         os.remove(self.input_file)
@@ -166,15 +473,17 @@ class Converter(object):
             os.path.basename(self.output_file),
             int(round(time_elapsed)),
             os.path.getsize(self.output_file),
-        ))
+        ), file=os.path.basename(self.output_file), stage='convert', duration=time_elapsed, size=os.path.getsize(self.output_file))
 
-    def _read_data(self):
+    def _read_data(self, packets_per_block):
+        """
+        Yields the start index, the packets, and the decoded channels of each block.
+        """
         with open(self.input_file, 'rb') as input_file:
-            self.filesize = os.path.getsize(self.input_file)
-            self.samples_count = int(self.filesize / 14)
-
-            raw_data = input_file.read(self.samples_count * 14)
-            self.data = self.device.read_data(raw_data)
+            for start in range(0, self.samples_count, packets_per_block):
+                count = min(packets_per_block, self.samples_count - start)
+                data = self.device.read_data(input_file.read(count * 14))
+                yield start, data, self.device.decode_channels(data)
 
     def _parse_filename(self):
         try:
@@ -191,14 +500,35 @@ class Converter(object):
         except:
             raise ValueError('Filename not matched! Ignoring file: {}'.format(os.path.basename(self.input_file)))
 
+    def _open_output_file(self):
+        if self.block_size is None:
+            return h5py.File(self.output_file + '.inprogress', 'w', driver='core')
+        return h5py.File(self.output_file + '.inprogress', 'w', rdcc_nbytes=STREAMING_CHUNK_CACHE_SIZE)
+
+    def _packets_per_block(self, chunk_length=1):
+        if self.block_size is None:
+            return max(self.samples_count, 1)
+        # whole chunks per block, so that no chunk is written twice
+        return max(self.block_size // 14 // chunk_length, 1) * chunk_length
+
+    def _read_trigger_ids(self):
+        with open(self.input_file, 'rb') as input_file:
+            first_packet = self.device.read_data(input_file.read(14))
+            input_file.seek((self.samples_count - 1) * 14)
+            last_packet = self.device.read_data(input_file.read(14))
+        return first_packet['trigger'][0], last_packet['trigger'][0]
+
     def _parse_data(self):
         g = self._parse_filename()
 
+        self.filesize = os.path.getsize(self.input_file)
+        self.samples_count = int(self.filesize / 14)
+
         if self.filesize % 14 != 0:
             _log('Last packet in file incomplete in file: {}'.format(self.input_file))
 
         os.makedirs(os.path.dirname(self.output_file), exist_ok=True)
-        with h5py.File(self.output_file + '.inprogress', 'w', driver='core') as output_file:
+        with self._open_output_file() as output_file:
             output_file.attrs.create('name', bytes(str(g['name']), 'ASCII'))
             output_file.attrs.create('year', int(g['year']), dtype='uint32')
             output_file.attrs.create('month', int(g['month']), dtype='uint32')
@@ -210,39 +540,79 @@ class Converter(object):
             output_file.attrs.create('sequence', int(g['sequence']), dtype='uint64')
             output_file.attrs.create('timezone', bytes(str(g['timezone']), 'ASCII'))
             output_file.attrs.create('frequency', self.frequency, dtype='uint64')
-            output_file.attrs.create('first_trigger_id', self.data['trigger'][0], dtype='uint16')
-            output_file.attrs.create('last_trigger_id', self.data['trigger'][-1], dtype='uint16')
-
-            self.device.parse_channels(self.data,
-                                       output_file,
-                                       shape=(self.samples_count,),
-                                       dtype='<i2',
-                                       fletcher32=True,
-                                       compression='gzip',
-                                       compression_opts=9,
-                                       shuffle=True,
-                                       )
 
-
-def _log(message):
+            first_trigger_id, last_trigger_id = self._read_trigger_ids()
+            output_file.attrs.create('first_trigger_id', first_trigger_id, dtype='uint16')
+            output_file.attrs.create('last_trigger_id', last_trigger_id, dtype='uint16')
+
+            blocks = self._read_data(self._packets_per_block())
+            if self.block_size is None:
+                # a single block, decode it only once
+                blocks = list(blocks)
+
+            channel_sums = None
+            if self.device.REQUIRES_CHANNEL_SUMS:
+                channel_sums = numpy.zeros(len(self.device.CHANNELS), dtype='int64')
+                for _, _, channels in blocks:
+                    channel_sums += numpy.sum(channels, axis=1, dtype='int64')
+            offsets = self.device.channel_offsets(channel_sums, self.samples_count)
+
+            dsets = self.device.create_datasets(output_file,
+                                                offsets,
+                                                shape=(self.samples_count,),
+                                                chunks=chunk_shape(self.chunk_layout, self.frequency, self.samples_count),
+                                                dtype='<i2',
+                                                **COMPRESSION_PROFILES[self.compression_profile]
+                                                )
+
+            if self.block_size is not None:
+                blocks = self._read_data(self._packets_per_block(dsets[0].chunks[0]))
+
+            writer = None
+            if self.compression_threads and all(ChunkCompressor.supports(dset) for dset in dsets):
+                writer = ChunkWriter(dsets, self.compression_threads)
+
+            scanner = TriggerGapScanner()
+            aggregator = SecondAggregator(self.device.CHANNELS, self.samples_count, self.frequency)
+            try:
+                for start, data, channels in blocks:
+                    scanner.scan(start, data['trigger'])
+                    for values, offset in zip(channels, offsets):
+                        if offset is not None:
+                            values -= offset
+                    aggregator.update(start, channels)
+                    if writer:
+                        writer.write(start, channels)
+                    else:
+                        for dset, values in zip(dsets, channels):
+                            dset[start:start + len(data)] = values
+            finally:
+                if writer:
+                    writer.close()
+
+            scanner.write(output_file)
+            aggregator.write(output_file)
+
+
+def _log(message, **fields):
     print(message, file=sys.stderr)
-
-    with open('files/converter.log', 'a') as f:
-        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime())
-        ms = message.split("\n")
-        for m in ms:
-            f.write("{} {}\n".format(timestamp, m))
+    get_writer(LOG_FILE, json_lines=LOG_FORMAT == 'json', max_bytes=LOG_MAX_BYTES).write(None, message, **fields)
 
 
 def __main__():
-    if len(sys.argv) != 3:
-        print('Invalid arguments. Expected: <filename> <frequency>', file=sys.stderr)
-        return
+    parser = argparse.ArgumentParser(description='Converts a raw .bin file of a DAQ unit to HDF5.')
+    parser.add_argument('filename')
+    parser.add_argument('frequency', type=int)
+    parser.add_argument('--block-size', type=int, default=None, help='stream the input in blocks of this many bytes')
+    parser.add_argument('--compression', choices=sorted(COMPRESSION_PROFILES), default=DEFAULT_COMPRESSION_PROFILE)
+    parser.add_argument('--threads', type=int, default=None, help='compress chunks in a thread pool of this size')
+    parser.add_argument('--chunks', choices=sorted(CHUNK_LAYOUTS), default=DEFAULT_CHUNK_LAYOUT)
+    args = parser.parse_args()
 
     try:
-        c = Converter(sys.argv[1], sys.argv[2])
+        c = Converter(args.filename, args.frequency, block_size=args.block_size, compression_profile=args.compression, compression_threads=args.threads, chunk_layout=args.chunks)
         c.start()
-    except Exception as e:
+    except Exception:
         _log("Converting failed: {}".format(traceback.format_exc()))
 
 
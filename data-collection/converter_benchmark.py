@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import os
+import tempfile
+import time
+import uuid
+
+import h5py
+import numpy
+
+import converter
+
+
+def legacy_microcontroller_channels(device, data):
+    # the per-channel extraction used before the single-pass decoding
+    channels = []
+    for channel_id in range(1, len(device.CHANNELS) + 1):
+        result = data.view('B').reshape(len(data), 14)[:, 2:14].astype('u2')
+        result &= 1 << channel_id
+        result >>= channel_id
+        result *= numpy.array([1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048], dtype='u2')
+        channels.append(numpy.sum(result, axis=1).astype('<i2'))
+    return channels
+
+
+def legacy_fpga_channels(device, data):
+    # create_dataset had to copy each strided field of the structured array
+    return [numpy.ascontiguousarray(data[name]) for name in device.CHANNELS]
+
+
+def _measure(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(*args)
+        time_elapsed = time.perf_counter() - start_time
+        best = time_elapsed if best is None else min(best, time_elapsed)
+    return best, result
+
+
+def benchmark_decode(args):
+    devices = [
+        ('MEDAL', converter.MicroControllerDevice(), legacy_microcontroller_channels),
+        ('CLEAR', converter.FPGADevice(), legacy_fpga_channels),
+    ]
+
+    raw_data = numpy.random.RandomState(42).randint(0, 256, size=args.packets * 14, dtype='u1').tobytes()
+    megabytes = len(raw_data) / 1024 / 1024
+
+    print("Decoding {} packets ({:.1f} MiB)...".format(args.packets, megabytes))
+    for name, device, legacy in devices:
+        data = device.read_data(raw_data)
+        legacy_time, expected = _measure(legacy, device, data, repeat=args.repeat)
+        decode_time, channels = _measure(device.decode_channels, data, repeat=args.repeat)
+
+        if not all(numpy.array_equal(e, c) for e, c in zip(expected, channels)):
+            raise ValueError('{}: decoded channels differ from legacy implementation'.format(name))
+
+        print("{:<6} legacy: {:>8.1f} MiB/s | single-pass: {:>8.1f} MiB/s | speedup: {:.1f}x".format(
+            name,
+            megabytes / legacy_time,
+            megabytes / decode_time,
+            legacy_time / decode_time,
+        ))
+
+
+def _channel_names(f):
+    return [name for name in f if isinstance(f[name], h5py.Dataset)]
+
+
+def evaluate_compression(args):
+    profiles = args.profiles or sorted(converter.COMPRESSION_PROFILES)
+    totals = collections.defaultdict(collections.Counter)
+
+    for file in args.files:
+        with h5py.File(file, 'r') as f:
+            channels = [f[name][:] for name in _channel_names(f)]
+
+        for profile in profiles:
+            options = converter.COMPRESSION_PROFILES[profile]
+            # an in-memory file, so that only compression and not the disk is measured
+            with h5py.File(uuid.uuid4().hex, 'w', driver='core', backing_store=False) as output_file:
+                for i, values in enumerate(channels):
+                    start_time = time.perf_counter()
+                    dset = output_file.create_dataset(str(i), data=values, **options)
+                    output_file.flush()
+                    totals[profile]['compress_seconds'] += time.perf_counter() - start_time
+
+                    start_time = time.perf_counter()
+                    dset[:]
+                    totals[profile]['decompress_seconds'] += time.perf_counter() - start_time
+
+                    totals[profile]['raw_bytes'] += values.nbytes
+                    totals[profile]['stored_bytes'] += dset.id.get_storage_size()
+
+    print("Evaluated {} files.".format(len(args.files)))
+    print("{:<8} | {:>13} | {:>15} | {:>6}".format('Profile', 'Compress', 'Decompress', 'Ratio'))
+    for profile in profiles:
+        t = totals[profile]
+        megabytes = t['raw_bytes'] / 1024 / 1024
+        print("{:<8} | {:>7.1f} MiB/s | {:>9.1f} MiB/s | {:>6.2f}".format(
+            profile,
+            megabytes / t['compress_seconds'],
+            megabytes / t['decompress_seconds'],
+            t['raw_bytes'] / t['stored_bytes'],
+        ))
+
+
+def _read_windows(dset, starts, length):
+    latencies = []
+    for start in starts:
+        start_time = time.perf_counter()
+        dset[start:start + length]
+        latencies.append(time.perf_counter() - start_time)
+    return numpy.array(latencies) * 1000
+
+
+def evaluate_read(args):
+    layouts = args.layouts or sorted(converter.CHUNK_LAYOUTS)
+    options = converter.COMPRESSION_PROFILES[args.profile]
+    random = numpy.random.RandomState(42)
+
+    print("{:<8} | {:>7} | {:>6} | {:>17} | {:>17} | {:>11}".format('Layout', 'Chunk', 'Ratio', '20 ms p50/p99', '1 s p50/p99', 'Sequential'))
+    for file in args.files:
+        with h5py.File(file, 'r') as f:
+            frequency = int(f.attrs['frequency'])
+            values = f[_channel_names(f)[0]][:]
+        window_lengths = [frequency // converter.MAINS_FREQUENCY, frequency]
+        starts = random.randint(0, len(values) - frequency, size=args.windows)
+
+        print(file)
+        for layout in layouts:
+            chunks = converter.chunk_shape(layout, frequency, len(values))
+            with tempfile.TemporaryDirectory(dir=args.tmp_dir) as directory:
+                # a file on disk, as the chunk index lookups are part of the read latency
+                filename = os.path.join(directory, 'layout.hdf5')
+                with h5py.File(filename, 'w') as output_file:
+                    dset = output_file.create_dataset('channel', data=values, chunks=chunks, **options)
+                    chunk_length = dset.chunks[0]
+                    ratio = values.nbytes / dset.id.get_storage_size()
+
+                latencies = []
+                for length in window_lengths:
+                    # without a chunk cache, so that each window decompresses its chunks
+                    with h5py.File(filename, 'r', rdcc_nbytes=0) as f:
+                        latencies.append(_read_windows(f['channel'], starts, length))
+
+                with h5py.File(filename, 'r') as f:
+                    start_time = time.perf_counter()
+                    f['channel'][:]
+                    sequential_time = time.perf_counter() - start_time
+
+            print("{:<8} | {:>7} | {:>6.2f} | {:>6.2f} / {:>6.2f} ms | {:>6.2f} / {:>6.2f} ms | {:>5.1f} MiB/s".format(
+                layout,
+                chunk_length,
+                ratio,
+                numpy.percentile(latencies[0], 50), numpy.percentile(latencies[0], 99),
+                numpy.percentile(latencies[1], 50), numpy.percentile(latencies[1], 99),
+                values.nbytes / 1024 / 1024 / sequential_time,
+            ))
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Benchmarks for the BLOND converter.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    decode = subparsers.add_parser('decode', help='channel decoding throughput against the legacy implementation')
+    decode.add_argument('--packets', type=int, default=250000 * 20, help='number of 14-byte packets to decode')
+    decode.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported')
+    decode.set_defaults(function=benchmark_decode)
+
+    compression = subparsers.add_parser('compression', help='compression throughput and ratio of each profile on sample BLOND files')
+    compression.add_argument('files', nargs='+', help='converted BLOND HDF5 files')
+    compression.add_argument('--profiles', nargs='+', choices=sorted(converter.COMPRESSION_PROFILES), help='profiles to evaluate, all by default')
+    compression.set_defaults(function=evaluate_compression)
+
+    read = subparsers.add_parser('read', help='random window latency and sequential read throughput of each chunk layout on sample BLOND files')
+    read.add_argument('files', nargs='+', help='converted BLOND HDF5 files')
+    read.add_argument('--layouts', nargs='+', choices=sorted(converter.CHUNK_LAYOUTS), help='chunk layouts to evaluate, all by default')
+    read.add_argument('--profile', choices=sorted(converter.COMPRESSION_PROFILES), default=converter.DEFAULT_COMPRESSION_PROFILE)
+    read.add_argument('--windows', type=int, default=200, help='number of random windows read per length')
+    read.add_argument('--tmp-dir', default=None, help='directory for the re-chunked files')
+    read.set_defaults(function=evaluate_read)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,134 @@
+import atexit
+import json
+import multiprocessing.util
+import os
+import queue
+import threading
+import time
+
+FLUSH_INTERVAL = 1  # seconds a message may wait in the buffer
+MAX_BATCH = 1000  # messages per write
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+class LogWriter(object):
+    """
+    Appends messages to a log file from a single background thread, so that logging
+    never waits for the disk. Messages are buffered and written in batches, as text
+    lines or as JSON lines with additional fields, e.g., unit, file, stage, duration.
+    If max_bytes is set, the file is rotated to .1, .2, ... once it grows beyond it.
+    """
+
+    def __init__(self, filename, json_lines=False, max_bytes=0, backup_count=5):
+        self.filename = filename
+        self.json_lines = json_lines
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.thread = None
+
+    def _start(self):
+        # a forked process does not inherit the thread, so it gets its own
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.Queue()
+                self.thread = threading.Thread(target=self._run, name='LogWriter-{}'.format(os.path.basename(self.filename)), daemon=True)
+                self.thread.start()
+                # multiprocessing children exit without running atexit handlers
+                multiprocessing.util.Finalize(self, self.flush, exitpriority=0)
+
+    def write(self, name, message, **fields):
+        """
+        Queues a message, a multi-line message becomes one text line per line.
+        """
+        if self.pid != os.getpid():
+            self._start()
+        self.queue.put((time.time(), name, message, fields))
+
+    def flush(self, timeout=10):
+        """
+        Waits until all queued messages are written.
+        """
+        if self.pid != os.getpid():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + FLUSH_INTERVAL
+            while len(batch) < MAX_BATCH and not isinstance(batch[-1], threading.Event):
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+            entries = [entry for entry in batch if not isinstance(entry, threading.Event)]
+            for _ in range(5):
+                # retry writing to the log file at least 5 times before silently giving up
+                try:
+                    self._write(entries)
+                except Exception:
+                    continue
+                break
+
+            for entry in batch:
+                if isinstance(entry, threading.Event):
+                    entry.set()
+
+    def _write(self, entries):
+        if not entries:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename, 'a') as f:
+            f.write(''.join(self._format(*entry) for entry in entries))
+            size = f.tell()
+
+        if self.max_bytes and size >= self.max_bytes:
+            try:
+                self._rotate()
+            except OSError:
+                # another process rotated the file at the same time
+                pass
+
+    def _format(self, created_at, name, message, fields):
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(created_at))
+        if self.json_lines:
+            record = {'time': timestamp, 'name': name, 'message': message}
+            record.update(fields)
+            return json.dumps(record, default=str) + "\n"
+
+        prefix = "{} {} ".format(timestamp, name) if name else "{} ".format(timestamp)
+        return ''.join("{}{}\n".format(prefix, m) for m in message.split("\n"))
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.filename, i)):
+                os.replace('{}.{}'.format(self.filename, i), '{}.{}'.format(self.filename, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.filename, '{}.1'.format(self.filename))
+        else:
+            os.remove(self.filename)
+
+
+def get_writer(filename, **kwargs):
+    """
+    Returns the writer of a log file, all messages for the same file go through one writer.
+    """
+    with _writers_lock:
+        if filename not in _writers:
+            _writers[filename] = LogWriter(filename, **kwargs)
+        return _writers[filename]
+
+
+@atexit.register
+def flush_all():
+    for writer in list(_writers.values()):
+        writer.flush()
@@ -0,0 +1,116 @@
+import queue
+import smtplib
+import sys
+import threading
+import time
+from email.mime.text import MIMEText
+
+REPEAT_INTERVAL = 60 * 60  # seconds before an alert of the same type and unit is sent again
+DIGEST_INTERVAL = 60 * 60  # seconds between digests of the held back alerts
+MAX_ALERTS_PER_HOUR = 20
+
+
+class SMTPBackend(object):
+
+    def send(self, subject, text):
+        with smtplib.SMTP() as s:
+            msg = MIMEText(text)
+            msg['From'] = 'energy-daq@BLOND.local'
+            msg['To'] = 'root'
+            msg['Subject'] = '[Energy-DAQ] {}'.format(subject)
+            s.send_message(msg)
+
+
+class FileBackend(object):
+    """
+    Appends alerts to a local file instead of sending them, e.g., for testing.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def send(self, subject, text):
+        with open(self.filename, 'a') as f:
+            f.write("Subject: [Energy-DAQ] {}\n\n{}\n{}\n".format(subject, text, '-' * 80))
+
+
+class AlertDispatcher(object):
+    """
+    Sends alerts from a background thread, so that the caller never waits for the
+    mail relay. An alert is sent right away the first time; repeats of the same type
+    and unit within REPEAT_INTERVAL, and alerts beyond MAX_ALERTS_PER_HOUR, are held
+    back and summarized in a digest every DIGEST_INTERVAL.
+    """
+
+    def __init__(self, backend, repeat_interval=REPEAT_INTERVAL, digest_interval=DIGEST_INTERVAL, max_alerts_per_hour=MAX_ALERTS_PER_HOUR):
+        self.backend = backend
+        self.repeat_interval = repeat_interval
+        self.digest_interval = digest_interval
+        self.max_alerts_per_hour = max_alerts_per_hour
+        self.queue = queue.Queue()
+        self.last_sent = {}  # (type, unit): time
+        self.sent_times = []
+        self.held_back = {}  # (type, unit): [count, first time, last time, last text]
+        self.last_digest = time.time()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def alert(self, subject, text, unit=None):
+        """
+        Queues an alert, the subject is its type.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='EnergyDAQAlertThread', daemon=True)
+                self.thread.start()
+        self.queue.put((time.time(), subject, text, unit))
+
+    def _run(self):
+        while True:
+            timeout = max(self.last_digest + self.digest_interval - time.time(), 0)
+            try:
+                self._dispatch(*self.queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            if time.time() - self.last_digest >= self.digest_interval:
+                self._send_digest()
+
+    def _dispatch(self, created_at, subject, text, unit):
+        key = (subject, unit)
+        self.sent_times = [t for t in self.sent_times if t > created_at - 60 * 60]
+
+        if created_at - self.last_sent.get(key, 0) < self.repeat_interval or len(self.sent_times) >= self.max_alerts_per_hour:
+            entry = self.held_back.setdefault(key, [0, created_at, created_at, text])
+            entry[0] += 1
+            entry[2] = created_at
+            entry[3] = text
+            return
+
+        self.last_sent[key] = created_at
+        self.sent_times.append(created_at)
+        self._send(subject, text)
+
+    def _send_digest(self):
+        self.last_digest = time.time()
+        if not self.held_back:
+            return
+
+        lines = []
+        for (subject, unit), (count, first, last, text) in sorted(self.held_back.items(), key=lambda item: item[1][1]):
+            lines.append("{}x {}{} between {} and {}, last:\n{}\n".format(
+                count,
+                subject,
+                ' ({})'.format(unit) if unit else '',
+                time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(first)),
+                time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(last)),
+                text,
+            ))
+        count = sum(entry[0] for entry in self.held_back.values())
+        self.held_back = {}
+        self._send('Digest of {} held back alerts'.format(count), "\n".join(lines))
+
+    def _send(self, subject, text):
+        try:
+            self.backend.send(subject, text)
+        except Exception as e:
+            print("Sending alert {} failed: {!r}".format(subject, e), file=sys.stderr)
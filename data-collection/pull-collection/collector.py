@@ -1,31 +1,66 @@
 #!/usr/bin/env python3
 
+import asyncio
+import atexit
+import collections
+import concurrent.futures
 import os
 import re
 import shutil
 import random
-import subprocess
 import sys
 import threading
 import time
 import datetime
+import glob
 import traceback
 import json
-import smtplib
+import queue
 import h5py
-import numpy
-from email.mime.text import MIMEText
 
 from natsort import natsorted
-from persistent_queue import PersistentQueue
 
-SSH_KEY_PATH = os.environ['SSH_KEY_PATH']
+# modules shared with the rest of the repository, or in the same directory when deployed
+REPOSITORY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+for directory in ['data-collection', 'misc', 'technical-validation']:
+    sys.path.append(os.path.join(REPOSITORY_DIRECTORY, directory))
+
+from alerts import AlertDispatcher, FileBackend, SMTPBackend
+from checksums_functions import append_manifest, move_with_checksum
+from jobs import JobTable, trace_spans
+from logwriter import get_writer
+from metrics import METRICS
+from per_file_data_checks_functions import find_flat_runs, results_filename, run_checks, write_results
+from transport import LocalTransport, SSHTransport, TransportError
+
+SSH_KEY_PATH = os.environ.get('SSH_KEY_PATH')
+LOCAL_UNITS_DIRECTORY = os.environ.get('LOCAL_UNITS_DIRECTORY')  # directory with one folder per unit, instead of ssh
 BASE_DIRECTORY = os.getcwd()
 DESTINATION_STORAGE = os.path.abspath('storage')
 DESTINATION_TEMP = os.path.abspath('tmp')
+JOBS_FILE = os.path.join(DESTINATION_TEMP, 'jobs.sqlite')
 MIN_FREE_TEMP = 4 * 1024 * 1024 * 1024  # bytes
 MIN_FREE_STORAGE = 4 * 1024 * 1024 * 1024  # bytes
 TIMEOUT = 1800  # seconds
+MAX_CONCURRENT_POLLS = 16
+MAX_CONCURRENT_TRANSFERS = 4
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', 0))  # KB/s shared by all transfers, 0 for the sum of the units' transfer speeds
+MIN_BANDWIDTH = 1000  # KB/s
+MAX_BATCH_FILES = 20  # files received with a single rsync
+POLL_MARGIN = 30  # seconds after a file is expected to be complete until the unit is polled
+POLL_JITTER = 15  # seconds, spreads the polls of units with the same cadence
+RETRY_INTERVAL = 30  # seconds between polls while a unit has files left, or its cadence is unknown
+MAX_POLL_INTERVAL = 300  # seconds between polls of a unit whose expected file is overdue
+MIN_FLAT_RUN = 502  # equal consecutive samples that make a channel invalid
+INGEST_CHECKS = os.environ.get('INGEST_CHECKS', '0') == '1'  # run the technical validation on each received file
+VERIFICATION_PROCESSES = int(os.environ.get('VERIFICATION_PROCESSES', max(os.cpu_count() - 1, 1)))
+VERIFICATION_RETRY_DELAY = 60  # seconds
+STATISTICS_INTERVAL = int(os.environ.get('STATISTICS_INTERVAL', 60))  # seconds between writing statistics.txt
+METRICS_ADDRESS = os.environ.get('METRICS_ADDRESS', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9410))
+ALERT_FILE = os.environ.get('ALERT_FILE')  # write alerts to this file instead of sending emails
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text or json
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 0))  # 0 leaves the rotation to logrotate
 
 
 class Unit(object):
@@ -52,6 +87,8 @@ UNITS = {}
 for unit in units:
     UNITS[unit.hostname] = unit
 
+ALERTS = AlertDispatcher(FileBackend(ALERT_FILE) if ALERT_FILE else SMTPBackend())
+
 
 def sizeof_fmt(num, suffix='B'):
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
@@ -61,19 +98,66 @@ def sizeof_fmt(num, suffix='B'):
     return "{:.1f} {}{}".format(num, 'Yi', suffix)
 
 
-def send_email(text, subject):
-    with smtplib.SMTP() as s:
-        if isinstance(text, Exception):
-            text = traceback.format_exc()
-
-        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime())
-        text = "{}\n\n{}".format(timestamp, text)
+def send_email(text, subject, unit=None):
+    """
+    Queues an alert and returns immediately, repeats of the same subject and unit are held back for a digest.
+    """
+    if isinstance(text, Exception):
+        text = traceback.format_exc()
+
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime())
+    text = "{}\n\n{}".format(timestamp, text)
+    ALERTS.alert(subject, text, unit)
+
+
+def parse_filename(file):
+    """
+    Returns the parts of a file name, or None if it is not the name of a BLOND file.
+    """
+    # unit-2016-06-04T22-24-42.411571+0200-0000001.hdf5
+    g = re.match(
+        '^'
+        '(?P<name>.+)-'
+        '(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})'
+        'T(?P<time>.+)-'
+        '(?P<sequence>\d+)'
+        '.hdf5'
+        '$',
+        os.path.basename(file))
+    return g.groupdict() if g else None
+
+
+def file_start_time(g):
+    """
+    Returns when the recording of a file started, as a Unix timestamp, or None if the time cannot be parsed.
+    """
+    # some units separate the UTC offset with a T: 22-24-42.411571T+0200
+    t = g['time'].replace('T', '')
+    try:
+        return datetime.datetime.strptime('{}-{}-{} {}'.format(g['year'], g['month'], g['day'], t), '%Y-%m-%d %H-%M-%S.%f%z').timestamp()
+    except ValueError:
+        return None
+
+
+def storage_directory(hostname, g):
+    return os.path.join(DESTINATION_STORAGE, hostname, g['year'], g['month'], g['day'])
+
+
+def write_log(log_name, message, **fields):
+    """
+    Prints a message and queues it for the log file, fields such as unit, file, stage
+    and duration are only written in the JSON format.
+    """
+    for _ in range(5):
+        # retry writing to stderr at least 5 times before silently giving up
+        try:
+            print("{:<21} | {}".format(log_name, message), file=sys.stderr)
+        except:
+            continue
+        break
 
-        msg = MIMEText(text)
-        msg['From'] = 'energy-daq@BLOND.local'
-        msg['To'] = 'root'
-        msg['Subject'] = '[Energy-DAQ] {}'.format(subject)
-        s.send_message(msg)
+    filename = '{}/logs/{}.log'.format(DESTINATION_STORAGE, log_name)
+    get_writer(filename, json_lines=LOG_FORMAT == 'json', max_bytes=LOG_MAX_BYTES).write(log_name, message, **fields)
 
 
 class BaseThread(threading.Thread):
@@ -82,27 +166,8 @@ class BaseThread(threading.Thread):
         super().__init__(*args, **kwargs)
         self.log_name = None
 
-    def _log(self, message):
-        for _ in range(5):
-            # retry writing to stderr at least 5 times before silently giving up
-            try:
-                print("{:<21} | {}".format(self.log_name, message), file=sys.stderr)
-            except:
-                continue
-            break
-
-        for _ in range(5):
-            # retry writing to log file at least 5 times before silently giving up
-            try:
-                os.makedirs('{}/logs'.format(DESTINATION_STORAGE), exist_ok=True)
-                with open('{}/logs/{}.log'.format(DESTINATION_STORAGE, self.log_name), 'a') as f:
-                    timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime())
-                    ms = message.split("\n")
-                    for m in ms:
-                        f.write("{} {} {}\n".format(timestamp, self.log_name, m))
-            except:
-                continue
-            break
+    def _log(self, message, **fields):
+        write_log(self.log_name, message, **fields)
 
     def run(self):
         self._log("{} started.".format(self.name))
@@ -118,181 +183,215 @@ class BaseThread(threading.Thread):
                     pass
 
 
-class CollectorThread(BaseThread):
+class UnitCollector(object):
+    """
+    Polls a single unit and receives its files. All units are driven by the
+    CollectorScheduler from one event loop.
+    """
 
-    def __init__(self, verification_semaphore, verification_queue, statistics_semaphore, statistics_queue, hostname):
-        super().__init__(name='EnergyDAQCollectorThread-{}-{}'.format(hostname, UNITS[hostname].ip))
-        self.verification_semaphore = verification_semaphore
-        self.verification_queue = verification_queue
-        self.statistics_semaphore = statistics_semaphore
+    def __init__(self, scheduler, transport, jobs, statistics_queue, hostname):
+        self.scheduler = scheduler
+        self.transport = transport
+        self.name = 'EnergyDAQCollector-{}-{}'.format(hostname, UNITS[hostname].ip)
+        self.jobs = jobs
         self.statistics_queue = statistics_queue
         self.hostname = hostname
         self.log_name = 'collector-{}'.format(self.hostname)
-        self.source = '{}@{}:/energy-daq/files/'.format(UNITS[self.hostname].username, UNITS[self.hostname].ip)
-        self.connection_error_count = 0
+        self.file_length = UNITS[hostname].file_length * 60  # seconds
+        self.last_file_start = None  # start of the newest file seen on the unit
+        self.files_left = True  # files were left on the unit by the last poll
+        self.empty_polls = 0  # polls in a row without a file
+        self.listed = set()  # files on the unit whose trace was started
 
-    def _process(self):
+    def _log(self, message, **fields):
+        write_log(self.log_name, message, **fields)
+
+    async def run(self):
+        self._log("{} started.".format(self.name))
+
+        while True:
+            try:
+                await self._process()
+            except Exception:
+                try:
+                    self._log(traceback.format_exc())
+                    send_email(traceback.format_exc(), 'Exception caught!', self.hostname)
+                except Exception:
+                    pass
+                # never busy-loop on the event loop shared by all units
+                await asyncio.sleep(30)
+
+    async def _process(self):
         first_run = True
 
         while True:
             if not first_run:
-                time.sleep(30 + random.randint(0, 30))
+                await asyncio.sleep(self._next_poll_delay())
             first_run = False
 
-            self._check_free_space()
+            await self._check_free_space()
 
-            files = self._get_file_list()
+            files = await self._get_file_list()
             if not files:
+                self.scheduler.backlog[self.hostname] = 0
+                self.files_left = False
+                self.empty_polls += 1
+                METRICS.inc('energy_daq_empty_polls_total', unit=self.hostname)
                 continue
+            self.empty_polls = 0
+            self._update_last_file_start(files)
+            self._trace_listed(files)
 
             ram_files = [f for f in files if f.startswith('ram')]
             persisted_files = [f for f in files if f.startswith('persisted')]
+            self.scheduler.backlog[self.hostname] = len(ram_files) + len(persisted_files)
 
             if len(persisted_files) > 0:
                 # if there are any persisted files, download them all,
                 # already persisted files are not being moved again
                 self._log('Receiving {} persisted files...'.format(len(persisted_files)))
-                for file in persisted_files:
-                    if not self._transfer_file(file):
+                for i in range(0, len(persisted_files), MAX_BATCH_FILES):
+                    if not await self._transfer_files(persisted_files[i:i + MAX_BATCH_FILES]):
                         break
-                    time.sleep(5)
+                # files in RAM may have been left
+                self.files_left = True
             elif len(ram_files) > 2:
                 # if there are more than 2 files in RAM, download only one and sleep,
                 # the mover could kick in between files
                 self._log('Receiving a single file from RAM. {} files still left...'.format(len(files)))
-                self._transfer_file(ram_files[0])
+                await self._transfer_files(ram_files[:1])
+                self.files_left = True
 
                 # sleep a bit extra to allow mover to do its job
-                time.sleep(60 + random.randint(0, 60))
+                await asyncio.sleep(60 + random.randint(0, 60))
             else:
                 # there are two files or less in ram, download them all,
                 # the mover should not kick in because there is enough room for 5-6 files
                 files_str = 'files' if len(ram_files) > 1 else 'file'
                 self._log('Receiving {} {} from RAM...'.format(len(ram_files), files_str))
-                for file in ram_files:
-                    if not self._transfer_file(file):
-                        break
-                    time.sleep(5)
-
-    def _build_ssh_command(self):
-        return [
-            'ssh',
-            '-i', SSH_KEY_PATH,
-            '-T',
-            '-o', 'StrictHostKeyChecking=no',
-            '-o', 'Compression=no',
-        ]
-
-    def _build_rsync_command(self):
-        return [
-            'rsync',
-            '--times',
-            '--archive',
-            '--no-perms',
-            '--no-group',
-            '--timeout=30',
-            '--bwlimit={}'.format(UNITS[self.hostname].transfer_speed),
-            '-e', ' '.join(self._build_ssh_command()),
-        ]
-
-    def _get_file_list(self):
+                self.files_left = not await self._transfer_files(ram_files)
+
+    def _trace_listed(self, files):
+        now = time.time()
+        for file in files:
+            if file not in self.listed:
+                self.jobs.trace(self.hostname, file, listed_at=now)
+        self.listed = set(files)
+
+    def _update_last_file_start(self, files):
+        for file in files:
+            g = parse_filename(file)
+            start = file_start_time(g) if g is not None else None
+            if start is not None and (self.last_file_start is None or start > self.last_file_start):
+                self.last_file_start = start
+
+    def _next_poll_delay(self):
+        """
+        Returns the seconds until the unit is polled again: shortly after its next file is
+        expected to be complete, or with an exponential backoff once that file is overdue.
+        """
+        jitter = random.uniform(0, POLL_JITTER)
+        if self.files_left or self.last_file_start is None:
+            return RETRY_INTERVAL + jitter
+
+        # the next file starts when the newest one ended, and is complete one file length later
+        expected_at = self.last_file_start + 2 * self.file_length + POLL_MARGIN
+        now = time.time()
+        if expected_at > now:
+            return expected_at - now + jitter
+        return min(RETRY_INTERVAL * 2 ** max(self.empty_polls - 1, 0), MAX_POLL_INTERVAL) + jitter
+
+    async def _get_file_list(self):
         os.makedirs(DESTINATION_TEMP, exist_ok=True)
 
         try:
-            c = self._build_rsync_command() + [
-                '--dry-run',
-                '--info=NAME1',
-                '--filter=include /ram',
-                '--filter=include /persisted',
-                '--filter=include **.hdf5',
-                '--filter=exclude *',
-                self.source,
-                DESTINATION_TEMP,
-            ]
-            output = subprocess.check_output(c, stderr=subprocess.STDOUT, universal_newlines=True, timeout=15)
-        except subprocess.TimeoutExpired:
-            self._log('Error: Could not get file list due to timeout.')
-            return
-        except subprocess.CalledProcessError as e:
-            if re.search('No route to host', e.output.strip()):
-                self.connection_error_count += 1
-                secs = (30, 60, 90, 120, 180, 240, 300)[self.connection_error_count if self.connection_error_count < 6 else -1]
-                time.sleep(secs)
+            async with self.scheduler.poll_slots:
+                METRICS.inc('energy_daq_polls_total', unit=self.hostname)
+                return await self.transport.list_files(DESTINATION_TEMP)
+        except TransportError as e:
+            if e.retry_in:
+                # the unit is unreachable, e.g., switched off
+                await asyncio.sleep(e.retry_in)
                 return None
-
-            self._log('Error: {}, {}'.format(
-                e.returncode,
-                e.output.strip()))
+            self._log('Error: {}'.format(e))
             return None
 
-        self.connection_error_count = 0
-        files = output.strip().split('\n')
-        files = [file for file in files if file and file.endswith('.hdf5') and not file == './']
-        return files
-
-    def _transfer_file(self, file):
-        try:
-            # unit-2016-06-04T22-24-42.411571+0200-0000001.hdf5
-            g = re.match(
-                '^'
-                '(?P<name>.+)-'
-                '(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})'
-                'T(?P<time>.+)-'
-                '(?P<sequence>\d+)'
-                '.hdf5'
-                '$',
-                os.path.basename(file)).groupdict()
-        except:
-            self._log('Error: Filename not matched! Ignoring file: {}'.format(os.path.basename(file)))
-            return
+    async def _transfer_files(self, files):
+        """
+        Receives a batch of files with a single transfer, and queues each received file
+        for verification with its own statistics record. Returns whether all files were received.
+        """
+        matches = {}
+        for file in files:
+            g = parse_filename(file)
+            if g is None:
+                self._log('Error: Filename not matched! Ignoring file: {}'.format(os.path.basename(file)))
+                continue
+            matches[file] = g
+        if not matches:
+            return False
+        files = [file for file in files if file in matches]
 
         output_directory = os.path.join(DESTINATION_TEMP, self.hostname)
         os.makedirs(output_directory, exist_ok=True)
 
-        if not self._check_free_space(quick_exit=True):
+        if not await self._check_free_space(quick_exit=True):
             return False
 
-        try:
-            c = self._build_rsync_command() + [
-                '--partial',
-                '--remove-source-files',
-                "{}/{}".format(self.source, file),
-                output_directory,
-            ]
-            start = datetime.datetime.now()
-            start_time = time.time()
-            subprocess.check_call(c, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            time_elapsed = time.time() - start_time
-            self._log('Received {} in {} seconds.'.format(file, int(round(time_elapsed))))
-        except subprocess.CalledProcessError as e:
-            output = "<no output>"
-            if e.output:
-                output = e.output.decode('UTF-8').strip()
-            self._log('Error: {}, {}'.format(e.returncode, output))
-            return
-
-        src = os.path.join(output_directory, os.path.basename(file))
-        dst = os.path.join(DESTINATION_STORAGE, self.hostname, g['year'], g['month'], g['day'])
-
-        stats_item = {
-            'hostname': self.hostname,
-            'state': {
-                'last_received_at': start,
-                'last_sequence_number': g['sequence'],
-                'last_file_size': os.path.getsize(src),
-                'last_transfer_duration': time_elapsed,
+        async with self.scheduler.transfer_slots:
+            bwlimit = self.scheduler.allocate_bandwidth(self.hostname)
+            try:
+                start = datetime.datetime.now()
+                start_time = time.time()
+                received, error = await self.transport.fetch_batch(files, output_directory, bwlimit)
+                time_elapsed = time.time() - start_time
+            except TransportError as e:
+                self._log('Error: {}'.format(e))
+                return False
+            finally:
+                self.scheduler.release_bandwidth(self.hostname)
+
+        if error:
+            self._log('Error: {}'.format(error))
+        self._log('Received {} of {} files in {} seconds at up to {} KB/s.'.format(len(received), len(files), int(round(time_elapsed)), bwlimit),
+                  unit=self.hostname, stage='transfer', duration=time_elapsed, files=[os.path.basename(file) for file in received])
+        self.scheduler.backlog[self.hostname] = max(self.scheduler.backlog[self.hostname] - len(received), 0)
+
+        sizes = [os.path.getsize(os.path.join(output_directory, os.path.basename(file))) for file in received]
+        for file, size in zip(received, sizes):
+            g = matches[file]
+            src = os.path.join(output_directory, os.path.basename(file))
+            dst = storage_directory(self.hostname, g)
+            # the share of the batch, assuming all bytes took equally long
+            transfer_duration = time_elapsed * size / max(sum(sizes), 1)
+            # from the end of the recording until the file is here
+            recording_start = file_start_time(g)
+            ingest_lag = time.time() - (recording_start + self.file_length) if recording_start is not None else None
+
+            stats_item = {
+                'hostname': self.hostname,
+                'state': {
+                    'last_received_at': start,
+                    'last_sequence_number': g['sequence'],
+                    'last_file_size': size,
+                    'last_transfer_duration': transfer_duration,
+                    'last_ingest_lag': ingest_lag,
+                }
             }
-        }
-
-        self.statistics_queue.push(stats_item)
-        self.statistics_semaphore.release()
+            METRICS.inc('energy_daq_files_received_total', unit=self.hostname)
+            METRICS.inc('energy_daq_bytes_received_total', size, unit=self.hostname)
+            METRICS.observe('energy_daq_transfer_seconds', transfer_duration, unit=self.hostname)
+            if ingest_lag is not None:
+                METRICS.observe('energy_daq_ingest_lag_seconds', ingest_lag, unit=self.hostname)
 
-        self.verification_queue.push((self.hostname, src, dst))
-        self.verification_semaphore.release()
+            self.statistics_queue.put(stats_item)
+            self.jobs.add(self.hostname, src, dst, size)
+            # all files of a batch share the transfer
+            self.jobs.trace(self.hostname, file, transfer_started_at=start_time, transfer_finished_at=start_time + time_elapsed)
 
-        return True
+        return len(received) == len(files)
 
-    def _check_free_space(self, quick_exit=False):
+    async def _check_free_space(self, quick_exit=False):
         email_sent = False
         free = shutil.disk_usage(DESTINATION_TEMP).free
         while free <= MIN_FREE_TEMP:
@@ -303,11 +402,49 @@ class CollectorThread(BaseThread):
             if not email_sent:
                 send_email(msg, 'No more free space in tmp directory!')
                 email_sent = True
-            time.sleep(300)
+            await asyncio.sleep(300)
             free = shutil.disk_usage(DESTINATION_TEMP).free
         return True
 
 
+class CollectorScheduler(object):
+    """
+    Drives the collection of all units from one event loop. Limits the number of
+    concurrent rsync processes and shares a total bandwidth budget between the
+    running transfers, weighted by the backlog of each unit.
+    """
+
+    def __init__(self, jobs, statistics_queue, transports, bandwidth_limit):
+        self.poll_slots = asyncio.Semaphore(MAX_CONCURRENT_POLLS)
+        self.transfer_slots = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
+        self.bandwidth_limit = bandwidth_limit
+        self.backlog = {hostname: 0 for hostname in transports}
+        self.allocated = {}
+        self.collectors = [
+            UnitCollector(self, transport, jobs, statistics_queue, hostname)
+            for hostname, transport in transports.items()
+        ]
+
+    def allocate_bandwidth(self, hostname):
+        """
+        Returns the --bwlimit for a new transfer from the given unit. Units with a
+        larger backlog get a larger share of the budget, without taking away
+        bandwidth from transfers already running.
+        """
+        # every unit produces files continuously, so it counts as having at least one
+        weights = {h: UNITS[h].transfer_speed * max(n, 1) for h, n in self.backlog.items()}
+        share = self.bandwidth_limit * weights[hostname] / sum(weights.values())
+        free = self.bandwidth_limit - sum(self.allocated.values())
+        self.allocated[hostname] = max(int(min(share, free)), MIN_BANDWIDTH)
+        return self.allocated[hostname]
+
+    def release_bandwidth(self, hostname):
+        self.allocated.pop(hostname, None)
+
+    async def run(self):
+        await asyncio.gather(*[collector.run() for collector in self.collectors])
+
+
 class StatisticsThread(BaseThread):
 
     class DateTimeEncoder(json.JSONEncoder):
@@ -317,24 +454,32 @@ class StatisticsThread(BaseThread):
 
             return json.JSONEncoder.default(self, o)
 
-    def __init__(self, statistics_semaphore, statistics_queue, verification_queue, storage_queue):
+    def __init__(self, statistics_queue, jobs, pool_statistics):
         super().__init__(name='EnergyDAQStatisticsThread')
-        self.statistics_semaphore = statistics_semaphore
+        self.pool_statistics = pool_statistics
         self.statistics_queue = statistics_queue
-        self.verification_queue = verification_queue
-        self.storage_queue = storage_queue
+        self.jobs = jobs
         self.log_name = 'statistics'
         self.statistics_file = '{}/logs/statistics.json'.format(DESTINATION_STORAGE)
         self.inactive_units = []
         self.state = {}
+        self.last_item_at = time.time()
+        self.last_dump = 0
+        self.lock = threading.Lock()
 
         self._load_state()
+        # the sequence numbers are needed to check the next file of each unit after a restart
+        atexit.register(self._dump_statistics)
 
     def _process(self):
-        self._update_state()
-        self._dump_statistics()
-        stats = self._generate_statistics()
-        self._save_statistics(stats)
+        if self._update_state():
+            self._dump_statistics()
+
+        # bursts of files only rewrite the statistics once per interval
+        if time.time() - self.last_dump >= STATISTICS_INTERVAL:
+            stats = self._generate_statistics()
+            self._save_statistics(stats)
+            self.last_dump = time.time()
 
     def _load_state(self):
         for hostname in UNITS.keys():
@@ -343,6 +488,7 @@ class StatisticsThread(BaseThread):
                 'last_sequence_number': None,
                 'last_file_size': None,
                 'last_transfer_duration': None,
+                'last_ingest_lag': None,
             }
 
         if os.path.exists(self.statistics_file) and os.path.getsize(self.statistics_file) > 0:
@@ -357,27 +503,37 @@ class StatisticsThread(BaseThread):
                 self._log("Invalid state loaded from json. Starting with empty state.")
 
     def _update_state(self):
-        if not self.statistics_semaphore.acquire(timeout=TIMEOUT):
-            send_email("Error: No file received in the last {} minutes!".format(TIMEOUT), 'No files received recently!')
-            self._log("Error: No file received in the last {} minutes!".format(TIMEOUT))
-            return
-
-        item = self.statistics_queue.pop()
-        self.statistics_queue.flush()
+        """
+        Applies the next statistics item, and returns whether the last sequence number of a unit changed.
+        """
+        try:
+            item = self.statistics_queue.get(timeout=STATISTICS_INTERVAL)
+        except queue.Empty:
+            if time.time() - self.last_item_at >= TIMEOUT:
+                send_email("Error: No file received in the last {} minutes!".format(TIMEOUT), 'No files received recently!')
+                self._log("Error: No file received in the last {} minutes!".format(TIMEOUT))
+                self.last_item_at = time.time()
+            return False
+        self.last_item_at = time.time()
 
         if item == 'none':
-            return
+            return False
 
         hostname = item['hostname']
 
         if int(item['state']['last_sequence_number']) != int(self.state[hostname]['last_sequence_number'] or 0) + 1:
-            send_email("{}: sequence id mismatch!\nold state: {}\nnew state: {}".format(hostname, self.state[hostname], item['state']), 'ID mismatch detected!')
+            send_email("{}: sequence id mismatch!\nold state: {}\nnew state: {}".format(hostname, self.state[hostname], item['state']), 'ID mismatch detected!', hostname)
 
-        self.state[hostname] = item['state']
+        changed = item['state']['last_sequence_number'] != self.state[hostname]['last_sequence_number']
+        with self.lock:
+            self.state[hostname] = item['state']
+        return changed
 
     def _dump_statistics(self):
-        with open(self.statistics_file, 'w') as f:
-            json.dump(self.state, f, cls=self.DateTimeEncoder, indent=2, sort_keys=True)
+        with self.lock:
+            with open(self.statistics_file + '.tmp', 'w') as f:
+                json.dump(self.state, f, cls=self.DateTimeEncoder, indent=2, sort_keys=True)
+            os.replace(self.statistics_file + '.tmp', self.statistics_file)
 
     def _generate_statistics(self):
         stats = []
@@ -385,17 +541,25 @@ class StatisticsThread(BaseThread):
         timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime())
         stats.append("Energy DAQ - Collector Statistics")
         stats.append("Statistics last updated: {}".format(timestamp))
-        stats.append("Statistics Queue: {} items unprocessed".format(self.statistics_queue.count()))
-        stats.append("Verification Queue: {} items unprocessed".format(self.verification_queue.count()))
-        stats.append("Storage Queue: {} items unprocessed".format(self.storage_queue.count()))
+        counts = self.jobs.counts()
+        stats.append("Statistics Queue: {} items unprocessed".format(self.statistics_queue.qsize()))
+        stats.append("Verification Queue: {} items unprocessed".format(counts['received']))
+        stats.append("Storage Queue: {} items unprocessed".format(counts['verified']))
+        verification_latency, storage_latency = self.jobs.stage_latencies(time.time() - 60 * 60)
+        if verification_latency is not None:
+            stats.append("Stage Latency: {:.1f} seconds until verified, {:.1f} seconds until stored (last hour)".format(verification_latency, storage_latency))
+        utilization, mean_wait, max_wait = self.pool_statistics.summary()
+        stats.append("Verification Pool: {} processes, {:.0%} utilized, {} files in progress".format(self.pool_statistics.processes, utilization, self.pool_statistics.in_progress))
+        if mean_wait is not None:
+            stats.append("Verification Wait: {:.1f} seconds average, {:.1f} seconds maximum".format(mean_wait, max_wait))
         stats.append("")
 
         active = [hostname for hostname in self.state.keys() if self.state[hostname]['last_received_at'] is not None and self.state[hostname]['last_received_at'] > datetime.datetime.now() - datetime.timedelta(minutes=UNITS[hostname].timeout)]
         inactive = [hostname for hostname in self.state.keys() if hostname not in active]
 
-        stats.append("-" * 90)
-        stats.append("  Hostname  |     Received At     | Sequence | File Size |  Transfer  | Time")
-        stats.append("-" * 90)
+        stats.append("-" * 102)
+        stats.append("  Hostname  |     Received At     | Sequence | File Size |  Transfer  | Ingest Lag | Time")
+        stats.append("-" * 102)
 
         if len(inactive) > 0:
             stats.append("Active:")
@@ -416,7 +580,7 @@ class StatisticsThread(BaseThread):
         inactive = [h for h in inactive if self.state[h]['last_received_at'] is not None]
         if inactive != self.inactive_units:
             if any(inactive):
-                send_email("Inactive units detected:\n\n{}\n\n".format("\n".join(inactive), stats), 'Inactive units detected!')
+                send_email("Inactive units detected:\n\n{}\n\n".format("\n".join(inactive), stats), 'Inactive units detected!', ', '.join(inactive))
             else:
                 send_email("All units operational.\n\n{}".format("\n".join(stats)), 'Everything is fine again!')
         self.inactive_units = inactive
@@ -428,106 +592,202 @@ class StatisticsThread(BaseThread):
 
     def _generate_list(self, hostnames):
         for hostname in natsorted(hostnames):
-            yield "{:<11} | {:^19} |  {:^7} | {:>9} | {:>10} | {}".format(
+            yield "{:<11} | {:^19} |  {:^7} | {:>9} | {:>10} | {:>10} | {}".format(
                 hostname,
                 self.state[hostname]['last_received_at'].strftime("%Y-%m-%d %H:%M:%S%z") if self.state[hostname]['last_received_at'] is not None else '-',
                 self.state[hostname]['last_sequence_number'] or '-',
                 sizeof_fmt(self.state[hostname]['last_file_size']) if self.state[hostname]['last_file_size'] is not None else '-',
                 "{:.2f} sec.".format(self.state[hostname]['last_transfer_duration']) if self.state[hostname]['last_transfer_duration'] is not None else '-',
+                "{:.0f} sec.".format(self.state[hostname]['last_ingest_lag']) if self.state[hostname].get('last_ingest_lag') is not None else '-',
                 datetime.timedelta(minutes=(int(self.state[hostname]['last_sequence_number']) * UNITS[hostname].file_length)) if self.state[hostname]['last_sequence_number'] is not None else '-',
             )
 
 
+def verify_file(file):
+    """
+    Returns the invalid channels of a received file, the failed technical validation checks
+    (None unless INGEST_CHECKS), and when the verification started and finished.
+    Runs in the verification pool.
+    """
+    started_at = time.time()
+    invalid_channels = []
+    fails = None
+    with h5py.File(file, 'r') as f:
+        for name, values in f.items():
+            if not isinstance(values, h5py.Dataset):
+                # metadata groups next to the channels
+                continue
+            starts, lengths = find_flat_runs(values[:], MIN_FLAT_RUN)
+            if len(starts) > 0:
+                invalid_channels.append('{} ({} samples flat at index {})'.format(name, lengths[0], starts[0]))
+
+        if INGEST_CHECKS:
+            # the file was just received and is still in the page cache
+            fails = [str(fail) for fail in run_checks(f)]
+    if fails is not None:
+        write_results(file, fails)
+    return invalid_channels, fails, started_at, time.time()
+
+
+class PoolStatistics(object):
+    """
+    Utilization and queue wait time of the verification pool over the last WINDOW seconds,
+    shared between the VerificationThread and the StatisticsThread.
+    """
+
+    WINDOW = 15 * 60  # seconds
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.jobs = collections.deque()  # (finished at, busy seconds, queue wait seconds)
+        self.in_progress = 0
+        self.started_at = time.time()
+
+    def add(self, started_at, finished_at, queued_at):
+        with self.lock:
+            self.jobs.append((finished_at, finished_at - started_at, started_at - queued_at if queued_at else None))
+
+    def summary(self):
+        """
+        Returns the utilization of the pool, and the mean and maximum queue wait time.
+        """
+        with self.lock:
+            now = time.time()
+            while self.jobs and self.jobs[0][0] < now - self.WINDOW:
+                self.jobs.popleft()
+            window = min(self.WINDOW, now - self.started_at)
+            utilization = sum(busy for _, busy, _ in self.jobs) / max(self.processes * window, 1)
+            waits = [wait for _, _, wait in self.jobs if wait is not None]
+        if not waits:
+            return utilization, None, None
+        return utilization, sum(waits) / len(waits), max(waits)
+
+
 class VerificationThread(BaseThread):
+    """
+    Verifies received files in a pool of processes. Files are handed to the storage in the
+    order they were received, so the storage and statistics see each unit's files in order.
+    """
 
-    def __init__(self, statistics_semaphore, statistics_queue, verification_semaphore, verification_queue, storage_semaphore, storage_queue):
+    def __init__(self, statistics_queue, jobs, pool_statistics):
         super().__init__(name='EnergyDAQVerificationThread')
-        self.statistics_semaphore = statistics_semaphore
         self.statistics_queue = statistics_queue
-        self.verification_semaphore = verification_semaphore
-        self.verification_queue = verification_queue
-        self.storage_semaphore = storage_semaphore
-        self.storage_queue = storage_queue
+        self.jobs = jobs
+        self.pool_statistics = pool_statistics
+        self.pool = concurrent.futures.ProcessPoolExecutor(pool_statistics.processes)
+        self.in_flight = collections.deque()  # (job, future), in the order received
         self.log_name = 'verification'
 
     def _process(self):
-        if not self.verification_semaphore.acquire(timeout=TIMEOUT):
-            send_email("Error: No file verified in the last {} minutes!".format(TIMEOUT), 'No files verified recently!')
-            self._log("Error: No file verified in the last {} minutes!".format(TIMEOUT))
+        self._submit()
+        if not self.in_flight:
             return
 
-        hostname, src, dst = self.verification_queue.peek()
-
+        job, future = self.in_flight[0]
         try:
-            self._check_file(hostname, src)
-
-            self.storage_queue.push((src, dst))
-            self.storage_semaphore.release()
-
-            self.verification_queue.delete()
-            self.verification_queue.flush()
+            invalid_channels, fails, started_at, finished_at = future.result(timeout=1)
+        except concurrent.futures.TimeoutError:
+            return
+        except concurrent.futures.process.BrokenProcessPool as e:
+            self._restart_pool(e)
+            return
         except Exception as e:
-            self.storage_semaphore.release()
-            self._log("Verifying file {} failed: {}\n{}".format(src, traceback.format_exc()))
+            self._log("Verifying file {} failed:\n{}".format(job.file, traceback.format_exc()))
             send_email(e, 'Exception caught!')
+            # the file stays first in line and is verified again
+            time.sleep(VERIFICATION_RETRY_DELAY)
+            self.in_flight[0] = (job, self.pool.submit(verify_file, job.file))
+            return
 
-        self.statistics_queue.push('none')
-        self.statistics_semaphore.release()
+        self.in_flight.popleft()
+        self.pool_statistics.in_progress = len(self.in_flight)
+        self.pool_statistics.add(started_at, finished_at, job.received_at)
+        self.jobs.trace(job.hostname, job.file, verification_started_at=started_at, verification_finished_at=finished_at)
+        self._check_file(job.hostname, job.file, invalid_channels, fails, finished_at - started_at)
+        METRICS.observe('energy_daq_verification_seconds', finished_at - started_at, unit=job.hostname)
+        METRICS.observe('energy_daq_verification_wait_seconds', started_at - job.received_at, unit=job.hostname)
+        METRICS.inc('energy_daq_files_verified_total', unit=job.hostname, result='invalid' if invalid_channels else 'valid')
+
+        self.jobs.update(job, 'verified')
+        self.statistics_queue.put('none')
+
+    def _submit(self):
+        """
+        Keeps up to two files per process in the pool, waiting for new files if none are in progress.
+        """
+        window = 2 * self.pool_statistics.processes
+        if len(self.in_flight) >= window:
+            return
 
-    def _check_file(self, hostname, file):
-        invalid_channels = []
-        with h5py.File(file, 'r') as f:
-            for name, values in f.items():
-                if not self._check_dataset(name, values):
-                    invalid_channels.append(name)
+        if self.in_flight:
+            jobs = self.jobs.next('received', limit=window)
+        else:
+            jobs = self.jobs.wait('received', TIMEOUT, limit=window)
+            if not jobs:
+                send_email("Error: No file verified in the last {} minutes!".format(TIMEOUT), 'No files verified recently!')
+                self._log("Error: No file verified in the last {} minutes!".format(TIMEOUT))
+                return
 
+        # the jobs in flight are still the first received ones
+        try:
+            for job in jobs[len(self.in_flight):]:
+                self.in_flight.append((job, self.pool.submit(verify_file, job.file)))
+        except concurrent.futures.process.BrokenProcessPool as e:
+            self._restart_pool(e)
+        self.pool_statistics.in_progress = len(self.in_flight)
+
+    def _restart_pool(self, e):
+        """
+        Replaces a pool that is broken by a dead worker process, e.g., killed when out of memory,
+        and submits the files in flight again, in the same order.
+        """
+        self._log("Verification pool broken, restarting it:\n{}".format(traceback.format_exc()))
+        send_email(e, 'Verification pool broken!')
+        self.pool.shutdown(wait=False)
+        # a file that kills its worker again is retried with a delay
+        time.sleep(VERIFICATION_RETRY_DELAY)
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.pool_statistics.processes)
+        self.in_flight = collections.deque((job, self.pool.submit(verify_file, job.file)) for job, _ in self.in_flight)
+
+    def _check_file(self, hostname, file, invalid_channels, fails, duration):
+        fields = dict(unit=hostname, file=os.path.basename(file), stage='verify', duration=duration)
         if invalid_channels:
-            send_email("Error: faulty values detected:\n{}\n{}".format(', '.join(invalid_channels), os.path.basename(file)), 'File contains errors!')
-            self._log("Error: faulty values detected: {} in {}".format(', '.join(invalid_channels), os.path.basename(file)))
+            send_email("Error: faulty values detected:\n{}\n{}".format(', '.join(invalid_channels), os.path.basename(file)), 'File contains errors!', hostname)
+            self._log("Error: faulty values detected: {} in {}".format(', '.join(invalid_channels), os.path.basename(file)), invalid_channels=invalid_channels, **fields)
         else:
-            self._log("All channels are valid in {}".format(os.path.basename(file)))
+            self._log("All channels are valid in {}".format(os.path.basename(file)), **fields)
+
+        if fails:
+            send_email("Error: technical validation failed:\n{}\n{}".format(os.path.basename(file), "\n".join(fails)), 'File failed technical validation!', hostname)
+            self._log("Error: technical validation failed in {}: {}".format(os.path.basename(file), '; '.join(fails)), unit=hostname, file=os.path.basename(file), stage='validate', fails=fails)
 
         # compare in megabyte
         s = os.path.getsize(file) / 1024 / 1024
         if s < UNITS[hostname].min_filesize:
-            send_email("Warning: File seems too small!\n{}\n{} MB".format(os.path.basename(file), s), 'File seems too small!')
+            send_email("Warning: File seems too small!\n{}\n{} MB".format(os.path.basename(file), s), 'File seems too small!', hostname)
         if s > UNITS[hostname].max_filesize:
-            send_email("Warning: File seems too large!\n{}\n{} MB".format(os.path.basename(file), s), 'File seems too large!')
-
-    def _check_dataset(self, name, values):
-        THRESHOLD = 500
-
-        count = 0
-        diff_sig = numpy.diff(values)
-        idx_zeros = (diff_sig == 0).nonzero()[0]
-
-        for i in range(idx_zeros.size - 1):
-            if idx_zeros[i + 1] - idx_zeros[i] == 1:
-                count += 1
-                if count == THRESHOLD:
-                    return False
-            else:
-                count = 0
-        return True
+            send_email("Warning: File seems too large!\n{}\n{} MB".format(os.path.basename(file), s), 'File seems too large!', hostname)
 
 
 class StorageThread(BaseThread):
 
-    def __init__(self, statistics_semaphore, statistics_queue, storage_semaphore, storage_queue):
+    def __init__(self, statistics_queue, jobs):
         super().__init__(name='EnergyDAQStorageThread')
-        self.statistics_semaphore = statistics_semaphore
         self.statistics_queue = statistics_queue
-        self.storage_semaphore = storage_semaphore
-        self.storage_queue = storage_queue
+        self.jobs = jobs
         self.log_name = 'storage'
 
     def _process(self):
-        if not self.storage_semaphore.acquire(timeout=TIMEOUT):
+        jobs = self.jobs.wait('verified', TIMEOUT)
+        if not jobs:
             send_email("Error: No file stored in the last {} minutes!".format(TIMEOUT), 'No files stored recently!')
             self._log("Error: No file stored in the last {} minutes!".format(TIMEOUT))
             return
 
-        src, dst = self.storage_queue.peek()
+        job = jobs[0]
+        src, dst = job.file, job.destination
+        picked_at = time.time()
 
         email_sent = False
         free = shutil.disk_usage(DESTINATION_STORAGE).free
@@ -541,53 +801,110 @@ class StorageThread(BaseThread):
             free = shutil.disk_usage(DESTINATION_STORAGE).free
 
         try:
+            start_time = time.time()
             os.makedirs(dst, exist_ok=True)
 
+            if os.path.exists(results_filename(src)):
+                # the validation results go first, so that a stored file never lacks them
+                shutil.move(results_filename(src), results_filename(os.path.join(dst, os.path.basename(src))))
+
             if not os.path.exists(os.path.join(dst, os.path.basename(src))):
-                shutil.move(src, dst)
+                # checksummed in the same pass, so that the archive needs no extra read for it
+                digest = move_with_checksum(src, os.path.join(dst, os.path.basename(src)))
+                append_manifest(dst, os.path.basename(src), digest)
             else:
                 self._log("File {} already exists, skipping.".format(os.path.basename(src)))
 
-            self._log("Moved file {} to {}/".format(os.path.relpath(src, BASE_DIRECTORY), os.path.relpath(dst, BASE_DIRECTORY)))
-            self.storage_queue.delete()
-            self.storage_queue.flush()
+            self._log("Moved file {} to {}/".format(os.path.relpath(src, BASE_DIRECTORY), os.path.relpath(dst, BASE_DIRECTORY)),
+                      unit=job.hostname, file=os.path.basename(src), stage='store', duration=time.time() - start_time)
+            self.jobs.update(job, 'stored')
+            METRICS.inc('energy_daq_files_stored_total', unit=job.hostname)
+            self._trace_stored(job, picked_at)
         except Exception as e:
-            self.storage_semaphore.release()
-            self._log("Moving file {} to {}/ failed: {}\n{}".format(os.path.relpath(src, BASE_DIRECTORY), os.path.relpath(dst, BASE_DIRECTORY), traceback.format_exc()))
+            self._log("Moving file {} to {}/ failed: {}\n{}".format(os.path.relpath(src, BASE_DIRECTORY), os.path.relpath(dst, BASE_DIRECTORY), e, traceback.format_exc()))
             send_email(e, 'Exception caught!')
-
-        self.statistics_queue.push('none')
-        self.statistics_semaphore.release()
+            # the file stays first in line
+            time.sleep(60)
+
+        self.statistics_queue.put('none')
+
+    def _trace_stored(self, job, picked_at):
+        self.jobs.trace(job.hostname, job.file, storage_started_at=picked_at, stored_at=time.time())
+        for trace in self.jobs.traces(file=job.file):
+            for stage, seconds in trace_spans(trace).items():
+                METRICS.observe('energy_daq_stage_seconds', seconds, unit=job.hostname, stage=stage)
+
+
+def collect_gauges(jobs, pool_statistics):
+    def collect(metrics):
+        counts = jobs.counts_by_unit()
+        for hostname in UNITS:
+            for state in ['received', 'verified']:
+                metrics.set('energy_daq_queue_depth', counts.get((hostname, state), 0), unit=hostname, state=state)
+        metrics.set('energy_daq_verification_pool_utilization', pool_statistics.summary()[0])
+    return collect
+
+
+def recover_jobs(jobs):
+    """
+    Adds the files in the temp directory to the job table, if their jobs were not committed before a crash,
+    and settles the jobs whose files are gone.
+    """
+    files = []
+    for hostname in UNITS:
+        for file in glob.glob(os.path.join(DESTINATION_TEMP, hostname, '*.hdf5')):
+            g = parse_filename(file)
+            if g is not None:
+                files.append((hostname, file, storage_directory(hostname, g)))
+    for job in jobs.recover(files):
+        msg = "Error: File {} is neither in the temp directory nor in the storage, marked as failed.".format(os.path.basename(job.file))
+        write_log('storage', msg, unit=job.hostname, file=os.path.basename(job.file), stage='recover')
+        send_email(msg, 'File lost!', job.hostname)
 
 
 def __main__():
     threads = []
 
-    statistics_queue = PersistentQueue('tmp/statistics.queue')
-    statistics_semaphore = threading.Semaphore(statistics_queue.count())
+    # log files are created in the background, the storage threads expect the directory
+    os.makedirs('{}/logs'.format(DESTINATION_STORAGE), exist_ok=True)
+
+    statistics_queue = queue.Queue()
+    jobs = JobTable(JOBS_FILE)
+    recover_jobs(jobs)
 
-    verification_queue = PersistentQueue('tmp/verification.queue')
-    verification_semaphore = threading.Semaphore(verification_queue.count())
+    pool_statistics = PoolStatistics(VERIFICATION_PROCESSES)
 
-    storage_queue = PersistentQueue('tmp/storage.queue')
-    storage_semaphore = threading.Semaphore(storage_queue.count())
+    METRICS.add_callback(collect_gauges(jobs, pool_statistics))
+    try:
+        METRICS.serve(METRICS_ADDRESS, METRICS_PORT)
+    except OSError as e:
+        # the endpoint is only for monitoring, the collection goes on without it
+        msg = "Error: Serving metrics on {}:{} failed: {}".format(METRICS_ADDRESS, METRICS_PORT, e)
+        write_log('metrics', msg)
+        send_email(msg, 'Metrics endpoint unavailable!')
 
-    statistics_thread = StatisticsThread(statistics_semaphore, statistics_queue, verification_queue, storage_queue)
+    statistics_thread = StatisticsThread(statistics_queue, jobs, pool_statistics)
     statistics_thread.start()
     threads.append(statistics_thread)
 
-    verification_thread = VerificationThread(statistics_semaphore, statistics_queue, verification_semaphore, verification_queue, storage_semaphore, storage_queue)
+    verification_thread = VerificationThread(statistics_queue, jobs, pool_statistics)
     verification_thread.start()
     threads.append(verification_thread)
 
-    storage_thread = StorageThread(statistics_semaphore, statistics_queue, storage_semaphore, storage_queue)
+    storage_thread = StorageThread(statistics_queue, jobs)
     storage_thread.start()
     threads.append(storage_thread)
 
-    for hostname in UNITS.keys():
-        thread = CollectorThread(verification_semaphore, verification_queue, statistics_semaphore, statistics_queue, hostname)
-        threads.append(thread)
-        thread.start()
+    # the event loop runs in the main thread, asyncio only supports subprocesses there on older Pythons
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bandwidth_limit = BANDWIDTH_LIMIT or sum(unit.transfer_speed for unit in UNITS.values())
+    if LOCAL_UNITS_DIRECTORY:
+        transports = {hostname: LocalTransport(unit, os.path.join(LOCAL_UNITS_DIRECTORY, hostname)) for hostname, unit in UNITS.items()}
+    else:
+        transports = {hostname: SSHTransport(unit, SSH_KEY_PATH) for hostname, unit in UNITS.items()}
+    scheduler = CollectorScheduler(jobs, statistics_queue, transports, bandwidth_limit)
+    loop.run_until_complete(scheduler.run())
 
     for thread in threads:
         thread.join()
@@ -0,0 +1,248 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+COMMIT_INTERVAL = 5  # seconds
+COMMIT_BATCH = 50  # changes
+RETENTION = 30 * 24 * 60 * 60  # seconds that stored and failed jobs and their traces are kept
+PRUNE_INTERVAL = 24 * 60 * 60  # seconds
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hostname TEXT NOT NULL,
+    file TEXT NOT NULL UNIQUE,
+    destination TEXT NOT NULL,
+    state TEXT NOT NULL,
+    size INTEGER,
+    received_at REAL,
+    verified_at REAL,
+    stored_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE INDEX IF NOT EXISTS jobs_hostname ON jobs (hostname, state);
+CREATE TABLE IF NOT EXISTS traces (
+    file TEXT PRIMARY KEY,
+    hostname TEXT NOT NULL,
+    listed_at REAL,
+    transfer_started_at REAL,
+    transfer_finished_at REAL,
+    verification_started_at REAL,
+    verification_finished_at REAL,
+    storage_started_at REAL,
+    stored_at REAL
+);
+CREATE INDEX IF NOT EXISTS traces_stored ON traces (hostname, stored_at);
+'''
+
+Job = collections.namedtuple('Job', ['id', 'hostname', 'file', 'destination', 'state', 'size', 'received_at', 'verified_at', 'stored_at'])
+Trace = collections.namedtuple('Trace', ['file', 'hostname', 'listed_at', 'transfer_started_at', 'transfer_finished_at', 'verification_started_at',
+                                         'verification_finished_at', 'storage_started_at', 'stored_at'])
+
+# stage: (start, end) of the time spent in it
+SPANS = collections.OrderedDict([
+    ('on_unit', ('listed_at', 'transfer_started_at')),
+    ('transfer', ('transfer_started_at', 'transfer_finished_at')),
+    ('verification_wait', ('transfer_finished_at', 'verification_started_at')),
+    ('verification', ('verification_started_at', 'verification_finished_at')),
+    ('storage_wait', ('verification_finished_at', 'storage_started_at')),
+    ('storage', ('storage_started_at', 'stored_at')),
+    ('total', ('listed_at', 'stored_at')),
+])
+
+
+def trace_spans(trace):
+    """
+    Returns the seconds a traced file spent in each stage it has passed.
+    """
+    spans = collections.OrderedDict()
+    for stage, (start, end) in SPANS.items():
+        if getattr(trace, start) is not None and getattr(trace, end) is not None:
+            spans[stage] = getattr(trace, end) - getattr(trace, start)
+    return spans
+
+
+class JobTable(object):
+    """
+    Durable state of every received file as it moves through the pipeline:
+    received, verified, stored, or failed if the file was lost. New jobs and traces
+    are committed in batches; state changes are committed right away, before the next
+    stage moves the file. recover() redoes what a crash lost. Finished jobs and their
+    traces are deleted after RETENTION, once a day.
+    """
+
+    STATES = ('received', 'verified', 'stored', 'failed')
+
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.last_commit = time.time()
+        self.last_prune = 0
+
+    def _execute(self, sql, parameters=()):
+        with self.condition:
+            cursor = self.connection.execute(sql, parameters)
+            if not sql.lstrip().upper().startswith('SELECT'):
+                self.pending += 1
+                self._commit_if_due()
+                self.condition.notify_all()
+            return cursor.fetchall()
+
+    def _commit_if_due(self):
+        if self.pending and (self.pending >= COMMIT_BATCH or time.time() - self.last_commit >= COMMIT_INTERVAL):
+            self.commit()
+        if time.time() - self.last_prune >= PRUNE_INTERVAL:
+            self.prune()
+
+    def commit(self):
+        with self.condition:
+            self.connection.commit()
+            self.pending = 0
+            self.last_commit = time.time()
+
+    def prune(self, retention=RETENTION):
+        """
+        Deletes the stored and failed jobs, and the traces, older than retention seconds.
+        """
+        before = time.time() - retention
+        with self.condition:
+            self.connection.execute('DELETE FROM jobs WHERE (state = ? AND stored_at < ?) OR (state = ? AND received_at < ?)', ('stored', before, 'failed', before))
+            # traces of files that were never stored, e.g., listed but not received, by when they were listed
+            self.connection.execute('DELETE FROM traces WHERE COALESCE(stored_at, listed_at, transfer_started_at) < ?', (before,))
+            self.commit()
+            self.last_prune = time.time()
+
+    def add(self, hostname, file, destination, size, received_at=None):
+        self._execute(
+            'INSERT OR REPLACE INTO jobs (hostname, file, destination, state, size, received_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (hostname, file, destination, 'received', size, received_at or time.time()))
+
+    def update(self, job, state):
+        """
+        Moves a job to the given state and records when, except for failed jobs.
+        The change is committed before returning.
+        """
+        if state == 'failed':
+            self._execute('UPDATE jobs SET state = ? WHERE id = ?', (state, job.id))
+        else:
+            self._execute('UPDATE jobs SET state = ?, {}_at = ? WHERE id = ?'.format(state), (state, time.time(), job.id))
+        self.commit()
+
+    def next(self, state, limit=1):
+        """
+        Returns up to limit jobs in the given state, the earliest received first.
+        """
+        rows = self._execute('SELECT * FROM jobs WHERE state = ? ORDER BY id LIMIT ?', (state, limit))
+        return [Job(*row) for row in rows]
+
+    def wait(self, state, timeout, limit=1):
+        """
+        Like next(), but waits up to timeout seconds for a job. Pending changes are
+        committed while waiting.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                jobs = self.next(state, limit)
+                remaining = deadline - time.time()
+                if jobs or remaining <= 0:
+                    return jobs
+                self.condition.wait(min(remaining, COMMIT_INTERVAL))
+                self._commit_if_due()
+
+    def files(self, state=None):
+        if state is None:
+            return set(row[0] for row in self._execute('SELECT file FROM jobs'))
+        return set(row[0] for row in self._execute('SELECT file FROM jobs WHERE state = ?', (state,)))
+
+    def counts(self, hostname=None):
+        """
+        Returns the number of jobs in each state, for all units or a single one.
+        """
+        if hostname is None:
+            rows = self._execute('SELECT state, COUNT(*) FROM jobs GROUP BY state')
+        else:
+            rows = self._execute('SELECT state, COUNT(*) FROM jobs WHERE hostname = ? GROUP BY state', (hostname,))
+        counts = dict.fromkeys(self.STATES, 0)
+        counts.update(rows)
+        return counts
+
+    def counts_by_unit(self):
+        """
+        Returns the number of jobs per unit and state, except for stored jobs.
+        """
+        rows = self._execute('SELECT hostname, state, COUNT(*) FROM jobs WHERE state != ? GROUP BY hostname, state', ('stored',))
+        return {(hostname, state): count for hostname, state, count in rows}
+
+    def stage_latencies(self, since):
+        """
+        Returns the mean seconds from received to verified and from verified to stored,
+        of the files stored since the given time.
+        """
+        rows = self._execute('SELECT AVG(verified_at - received_at), AVG(stored_at - verified_at) FROM jobs WHERE state = ? AND stored_at >= ?', ('stored', since))
+        return rows[0]
+
+    def trace(self, hostname, file, **timestamps):
+        """
+        Records when a file reached the given points of the pipeline, e.g., transfer_started_at.
+        Files are traced by their name, from the first time they are listed on the unit.
+        """
+        name = os.path.basename(file)
+        self._execute('INSERT OR IGNORE INTO traces (file, hostname) VALUES (?, ?)', (name, hostname))
+        # a file is listed by every poll until it is received
+        columns = ', '.join('{0} = COALESCE({0}, ?)'.format(c) if c == 'listed_at' else '{} = ?'.format(c) for c in timestamps)
+        self._execute('UPDATE traces SET {} WHERE file = ?'.format(columns), tuple(timestamps.values()) + (name,))
+
+    def traces(self, hostname=None, since=None, file=None):
+        """
+        Returns the traces of the files stored since the given time, for all units or a single
+        one, or the trace of a single file.
+        """
+        if file is not None:
+            rows = self._execute('SELECT * FROM traces WHERE file = ?', (os.path.basename(file),))
+            return [Trace(*row) for row in rows]
+
+        conditions = ['stored_at >= ?']
+        parameters = [since or 0]
+        if hostname is not None:
+            conditions.append('hostname = ?')
+            parameters.append(hostname)
+        rows = self._execute('SELECT * FROM traces WHERE {} ORDER BY stored_at'.format(' AND '.join(conditions)), tuple(parameters))
+        return [Trace(*row) for row in rows]
+
+    def recover(self, files):
+        """
+        Adds received files that are not in the table, as the last changes before a
+        crash may not have been committed. Takes (hostname, file, destination) tuples.
+
+        Jobs whose file is no longer in the temp directory are marked stored if the file
+        reached its destination, and failed otherwise. Returns the failed jobs.
+        """
+        self.prune()
+        known = self.files()
+        for hostname, file, destination in files:
+            if file not in known:
+                self.add(hostname, file, destination, os.path.getsize(file))
+
+        failed = []
+        rows = self._execute('SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY id', ('received', 'verified'))
+        for job in [Job(*row) for row in rows]:
+            if os.path.exists(job.file):
+                continue
+            if os.path.exists(os.path.join(job.destination, os.path.basename(job.file))):
+                # moved by the storage before the crash
+                self.update(job, 'stored')
+            else:
+                self.update(job, 'failed')
+                failed.append(job)
+        self.commit()
+        return failed
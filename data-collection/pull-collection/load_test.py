@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy
+
+import simulator
+import traces
+from jobs import JobTable
+
+STAGES = [
+    # name, from, to
+    ('transfer', 'recorded', 'received_at'),
+    ('verify', 'received_at', 'verified_at'),
+    ('store', 'verified_at', 'stored_at'),
+    ('total', 'recorded', 'stored_at'),
+]
+
+
+def _count_files(directory):
+    return sum(len([name for name in names if name.endswith('.hdf5')]) for _, _, names in os.walk(directory))
+
+
+def _queue_depths(jobs_file, units_directory):
+    depths = {'unit': _count_files(units_directory), 'received': 0, 'verified': 0}
+    if os.path.exists(jobs_file):
+        with sqlite3.connect(jobs_file) as connection:
+            for state, count in connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'):
+                depths[state] = count
+    return depths
+
+
+def _stage_latencies(jobs_file, recorded):
+    with sqlite3.connect(jobs_file) as connection:
+        rows = connection.execute('SELECT file, received_at, verified_at, stored_at FROM jobs WHERE state = ?', ('stored',)).fetchall()
+
+    latencies = {name: [] for name, _, _ in STAGES}
+    for file, received_at, verified_at, stored_at in rows:
+        times = {'recorded': recorded.get(os.path.basename(file)), 'received_at': received_at, 'verified_at': verified_at, 'stored_at': stored_at}
+        for name, start, end in STAGES:
+            if times[start] is not None and times[end] is not None:
+                latencies[name].append(times[end] - times[start])
+    return len(rows), latencies
+
+
+def _configure_collector(collector, units, speedup):
+    # the collector only knows the real fleet, so it gets the simulated one
+    collector.UNITS.clear()
+    for unit in units:
+        medal = unit.hostname.startswith('medal')
+        collector.UNITS[unit.hostname] = collector.Unit(
+            hostname=unit.hostname, ip='127.0.0.1', username='simulator',
+            transfer_speed=6000 if medal else 15000,
+            timeout=(25 if medal else 11) / speedup,
+            file_length=unit.file_length / 60,
+            min_filesize=unit.file_size / 1024 / 1024 * 0.8,
+            max_filesize=unit.file_size / 1024 / 1024 * 1.2,
+        )
+
+    # the poll intervals follow the faster cadence
+    collector.POLL_MARGIN /= speedup
+    collector.POLL_JITTER /= speedup
+    collector.RETRY_INTERVAL /= speedup
+    collector.MAX_POLL_INTERVAL /= speedup
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Runs the pull collector against a simulated fleet of DAQ units, and reports throughput, stage latencies and queue depths.')
+    parser.add_argument('work_dir', help='empty directory for the simulated units and the collector\'s tmp and storage directories')
+    parser.add_argument('--medal-units', type=int, default=15)
+    parser.add_argument('--clear-units', type=int, default=1)
+    parser.add_argument('--speedup', type=float, default=1, help='divides the file length of all units')
+    parser.add_argument('--size-scale', type=float, default=1, help='multiplies the samples per file of all units, only files of scale 1 pass the dataset length check')
+    parser.add_argument('--duration', type=float, default=3600, help='seconds during which the units emit files')
+    parser.add_argument('--drain-timeout', type=float, default=600, help='seconds to wait for the collector to store the remaining files')
+    parser.add_argument('--sample-interval', type=float, default=5, help='seconds between queue depth samples')
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.chdir(args.work_dir)
+    units_directory = os.path.abspath('units')
+    jobs_file = os.path.join('tmp', 'jobs.sqlite')
+
+    # the collector reads its configuration when it is imported
+    os.environ['LOCAL_UNITS_DIRECTORY'] = units_directory
+    os.environ.setdefault('ALERT_FILE', os.path.abspath('alerts.txt'))
+    os.environ.setdefault('METRICS_PORT', '0')
+    import collector
+
+    units = simulator.create_units(units_directory, args.medal_units, args.clear_units, args.speedup, args.size_scale)
+    _configure_collector(collector, units, args.speedup)
+
+    fleet = simulator.Fleet(units, args.duration)
+    collector_thread = threading.Thread(target=collector.__main__, name='Collector', daemon=True)
+    collector_thread.start()
+    start_time = time.time()
+    fleet.start()
+
+    samples = []
+    while fleet.is_alive() or time.time() - start_time < args.duration + args.drain_timeout:
+        time.sleep(args.sample_interval)
+        depths = _queue_depths(jobs_file, units_directory)
+        samples.append(depths)
+        print("{:>6.0f} s | {} files emitted | {} on the units | {} received | {} verified".format(
+            time.time() - start_time, len(fleet.emitted), depths['unit'], depths['received'], depths['verified']), file=sys.stderr)
+        if not fleet.is_alive() and depths['unit'] == depths['received'] == depths['verified'] == 0:
+            break
+    time_elapsed = time.time() - start_time
+
+    recorded = {os.path.basename(path): end for _, path, end in fleet.emitted}
+    stored, latencies = _stage_latencies(jobs_file, recorded)
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk('storage') for name in names if name.endswith('.hdf5'))
+    polls = sum(value for (name, _), value in collector.METRICS.values.items() if name == 'energy_daq_polls_total')
+    empty_polls = sum(value for (name, _), value in collector.METRICS.values.items() if name == 'energy_daq_empty_polls_total')
+
+    print("Units: {} MEDAL, {} CLEAR, speedup {}x, size scale {}x".format(args.medal_units, args.clear_units, args.speedup, args.size_scale))
+    print("Files: {} emitted, {} stored in {:.0f} seconds".format(len(fleet.emitted), stored, time_elapsed))
+    print("Throughput: {:.2f} files/min, {:.1f} MiB/s".format(stored / time_elapsed * 60, size / 1024 / 1024 / time_elapsed))
+    print("Polls: {} ({} without files)".format(polls, empty_polls))
+    print("")
+    print("{:<8} | {:>9} | {:>9} | {:>9} | {:>9}".format('Stage', 'p50', 'p90', 'p99', 'max'))
+    for name, _, _ in STAGES:
+        if not latencies[name]:
+            continue
+        p50, p90, p99 = numpy.percentile(latencies[name], [50, 90, 99])
+        print("{:<8} | {:>7.1f} s | {:>7.1f} s | {:>7.1f} s | {:>7.1f} s".format(name, p50, p90, p99, max(latencies[name])))
+    print("")
+    print("{:<8} | {:>6} | {:>6}".format('Queue', 'mean', 'max'))
+    for state in ['unit', 'received', 'verified']:
+        values = [sample[state] for sample in samples] or [0]
+        print("{:<8} | {:>6.1f} | {:>6}".format(state, numpy.mean(values), max(values)))
+    print("")
+    traces.print_summary(JobTable(jobs_file).traces(since=start_time))
+
+
+if __name__ == '__main__':
+    __main__()
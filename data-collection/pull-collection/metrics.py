@@ -0,0 +1,121 @@
+import http.server
+import threading
+
+SECONDS_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# name: (type, help)
+METRIC_TYPES = {
+    'energy_daq_polls_total': ('counter', 'File list requests sent to a unit.'),
+    'energy_daq_empty_polls_total': ('counter', 'File list requests that found no file or failed.'),
+    'energy_daq_files_received_total': ('counter', 'Files received from a unit.'),
+    'energy_daq_bytes_received_total': ('counter', 'Bytes received from a unit.'),
+    'energy_daq_transfer_seconds': ('histogram', 'Transfer time per received file.'),
+    'energy_daq_ingest_lag_seconds': ('histogram', 'Time from the end of a recording until its file was received.'),
+    'energy_daq_verification_seconds': ('histogram', 'Verification time per file.'),
+    'energy_daq_verification_wait_seconds': ('histogram', 'Time a received file waited for verification.'),
+    'energy_daq_files_verified_total': ('counter', 'Files verified, by result.'),
+    'energy_daq_files_stored_total': ('counter', 'Files moved to the storage.'),
+    'energy_daq_stage_seconds': ('histogram', 'Time a stored file spent in each pipeline stage, from its traces.'),
+    'energy_daq_queue_depth': ('gauge', 'Files waiting for a pipeline stage.'),
+    'energy_daq_verification_pool_utilization': ('gauge', 'Busy fraction of the verification pool over the last 15 minutes.'),
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics(object):
+    """
+    In-memory counters, gauges and histograms of the collector, rendered in the
+    Prometheus text format. Gauges that are expensive to keep up to date can be
+    computed by callbacks when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels): value, or [bucket counts, sum, count] for histograms
+        self.callbacks = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.setdefault(key, [[0] * len(buckets), 0, 0, buckets])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_callback(self, callback):
+        """
+        Registers a function that is called with this object before rendering.
+        """
+        self.callbacks.append(callback)
+
+    def render(self):
+        for callback in self.callbacks:
+            callback(self)
+
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for name, _ in self.values)):
+                metric_type, help_text = METRIC_TYPES.get(name, ('untyped', ''))
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                for (n, labels), value in sorted(self.values.items(), key=lambda item: item[0]):
+                    if n != name:
+                        continue
+                    if metric_type != 'histogram':
+                        lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+                        continue
+                    counts, total, count, buckets = value
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', bound),)), bucket_count))
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)), count))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), total))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, address, port):
+        """
+        Serves the metrics at http://address:port/metrics from a background thread.
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are too frequent for the log
+                pass
+
+        server = http.server.HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='EnergyDAQMetricsThread', daemon=True)
+        thread.start()
+        return server
+
+
+METRICS = Metrics()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import os
+import random
+import threading
+import time
+
+import h5py
+import numpy
+
+MAX_RAM_FILES = 5  # files kept in ram/ before the oldest is moved to persisted/, as the unit's mover does
+MAINS_FREQUENCY = 49.97  # Hz, slightly off 50 Hz, so that the samples of successive cycles differ
+VOLTAGE_RMS = 230  # V
+CURRENT_RMS = 2  # A
+
+
+_blocks = {}
+
+
+def _sample_block(samples, frequency, calibration_factors):
+    # one block of samples per kind of unit, reused for every file, in the range of the calibrated real signals
+    key = (samples, frequency, tuple(sorted(calibration_factors.items())))
+    if key not in _blocks:
+        t = numpy.arange(samples) / frequency
+        rs = numpy.random.RandomState(len(_blocks))
+        data = {}
+        for i, (name, calibration_factor) in enumerate(sorted(calibration_factors.items())):
+            if name.startswith('voltage'):
+                amplitude = VOLTAGE_RMS * numpy.sqrt(2) / calibration_factor
+            else:
+                amplitude = CURRENT_RMS * numpy.sqrt(2) / calibration_factor
+            signal = amplitude * numpy.sin(2 * numpy.pi * MAINS_FREQUENCY * t + i)
+            data[name] = numpy.rint(signal + rs.normal(0, amplitude / 200, samples)).astype('<i2')
+        _blocks[key] = data
+    return _blocks[key]
+
+
+class SimulatedUnit(object):
+    """
+    A fake DAQ unit that writes synthetic files into a directory with the layout of
+    /energy-daq/files on a real unit. The files have the channels, attributes and length
+    of converted ones and pass the technical validation, but are stored uncompressed,
+    so that writing them costs little CPU.
+    """
+
+    def __init__(self, hostname, file_length, recording_length, frequency, calibration_factors, directory, size_scale=1):
+        self.hostname = hostname
+        self.file_length = file_length  # seconds between two files
+        self.recording_length = recording_length  # seconds of samples in a file
+        self.frequency = frequency
+        self.calibration_factors = calibration_factors  # per channel
+        self.directory = directory
+        self.sequence = 0
+
+        # files with another size_scale than 1 fail the dataset length check
+        samples = max(int(frequency * recording_length * size_scale), 1)
+        self.data = _sample_block(samples, frequency, calibration_factors)
+        self.file_size = samples * 2 * len(calibration_factors)  # bytes
+
+    def write_file(self, start):
+        """
+        Writes the file of the recording that started at the given time into ram/, and
+        returns its path.
+        """
+        self.sequence += 1
+        timestamp = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).astimezone()
+        filename = '{}-{}-{:07d}.hdf5'.format(self.hostname, timestamp.strftime('%Y-%m-%dT%H-%M-%S.%f%z'), self.sequence)
+
+        ram = os.path.join(self.directory, 'ram')
+        os.makedirs(ram, exist_ok=True)
+        tmp = os.path.join(ram, '.{}.tmp'.format(filename))
+        with h5py.File(tmp, 'w') as f:
+            # the attributes of a converted file
+            f.attrs.create('name', numpy.bytes_(self.hostname))
+            f.attrs.create('year', timestamp.year, dtype='uint32')
+            f.attrs.create('month', timestamp.month, dtype='uint32')
+            f.attrs.create('day', timestamp.day, dtype='uint32')
+            f.attrs.create('hours', timestamp.hour, dtype='uint32')
+            f.attrs.create('minutes', timestamp.minute, dtype='uint32')
+            f.attrs.create('seconds', timestamp.second, dtype='uint32')
+            f.attrs.create('microseconds', timestamp.microsecond, dtype='uint32')
+            f.attrs.create('sequence', self.sequence, dtype='uint64')
+            f.attrs.create('timezone', numpy.bytes_(timestamp.strftime('%z')))
+            f.attrs.create('frequency', self.frequency, dtype='uint64')
+            f.attrs.create('first_trigger_id', 0, dtype='uint16')
+            f.attrs.create('last_trigger_id', (len(next(iter(self.data.values()))) - 1) % 2**16, dtype='uint16')
+            f.attrs.create('dropped_packets', 0, dtype='uint64')
+            for name, values in self.data.items():
+                dset = f.create_dataset(name, data=values)
+                dset.attrs.create('calibration_factor', self.calibration_factors[name], dtype='f8')
+        os.replace(tmp, os.path.join(ram, filename))
+        self._move_old_files()
+        return os.path.join(ram, filename)
+
+    def _move_old_files(self):
+        ram = os.path.join(self.directory, 'ram')
+        files = sorted(file for file in os.listdir(ram) if file.endswith('.hdf5'))
+        if len(files) <= MAX_RAM_FILES:
+            return
+        persisted = os.path.join(self.directory, 'persisted')
+        os.makedirs(persisted, exist_ok=True)
+        for file in files[:len(files) - MAX_RAM_FILES]:
+            os.replace(os.path.join(ram, file), os.path.join(persisted, file))
+
+
+def create_units(root, medal_units=15, clear_units=1, speedup=1, size_scale=1):
+    """
+    Returns simulated units shaped like the MEDAL and CLEAR units of BLOND-50, with the
+    time between files divided by speedup and the samples per file multiplied by size_scale.
+    """
+    # calibration factors of the converter
+    medal = {'current1': 0.015151515, 'voltage': 0.2853}
+    medal.update({'current{}'.format(c + 1): 0.005405405 for c in range(1, 6)})
+    clear = {'current1': 0.0009625, 'current2': 0.0009625, 'current3': 0.0009625, 'voltage1': 0.011170775, 'voltage2': 0.011170775, 'voltage3': 0.011170775}
+
+    units = []
+    for i in range(medal_units):
+        hostname = 'medal-{}'.format(i + 1)
+        units.append(SimulatedUnit(hostname, 15 * 60 / speedup, 15 * 60, 6400, medal, os.path.join(root, hostname), size_scale))
+    for i in range(clear_units):
+        hostname = 'clear' if i == 0 else 'clear-{}'.format(i + 1)
+        units.append(SimulatedUnit(hostname, 5 * 60 / speedup, 5 * 60, 50000, clear, os.path.join(root, hostname), size_scale))
+    return units
+
+
+class Fleet(threading.Thread):
+    """
+    Emits the files of all simulated units at their cadence. The units start at random
+    offsets, as the real ones are not synchronized. Each file is named after the start of
+    its recording and appears when the recording ends.
+    """
+
+    def __init__(self, units, duration=None):
+        super().__init__(name='SimulatedFleet', daemon=True)
+        self.units = units
+        self.duration = duration
+        self.emitted = []  # (hostname, path, recording end)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self):
+        start_time = time.time()
+        next_file = {unit.hostname: start_time + random.uniform(0, unit.file_length) for unit in self.units}
+        units = {unit.hostname: unit for unit in self.units}
+
+        while not self.stopped.is_set():
+            hostname = min(next_file, key=next_file.get)
+            end = next_file[hostname]
+            if self.duration is not None and end > start_time + self.duration:
+                break
+            if self.stopped.wait(max(end - time.time(), 0)):
+                break
+
+            unit = units[hostname]
+            path = unit.write_file(end - unit.file_length)
+            with self.lock:
+                self.emitted.append((hostname, path, end))
+            next_file[hostname] = end + unit.file_length
+
+    def stop(self):
+        self.stopped.set()
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Simulates a fleet of DAQ units that write files into local directories, for the LOCAL_UNITS_DIRECTORY of the pull collector.')
+    parser.add_argument('root', help='directory with one folder per simulated unit')
+    parser.add_argument('--medal-units', type=int, default=15)
+    parser.add_argument('--clear-units', type=int, default=1)
+    parser.add_argument('--speedup', type=float, default=1, help='divides the file length of all units')
+    parser.add_argument('--size-scale', type=float, default=1, help='multiplies the samples per file of all units, only files of scale 1 pass the dataset length check')
+    parser.add_argument('--duration', type=float, default=None, help='seconds until the simulation stops, unlimited by default')
+    args = parser.parse_args()
+
+    fleet = Fleet(create_units(args.root, args.medal_units, args.clear_units, args.speedup, args.size_scale), args.duration)
+    fleet.start()
+    try:
+        while fleet.is_alive():
+            fleet.join(10)
+            print("{} files emitted".format(len(fleet.emitted)))
+    except KeyboardInterrupt:
+        fleet.stop()
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import time
+
+from jobs import SPANS, JobTable, trace_spans
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def summarize(traces):
+    """
+    Returns the seconds spent in each stage by the traced files, per unit and stage.
+    """
+    spans = collections.defaultdict(lambda: collections.defaultdict(list))
+    for trace in traces:
+        for stage, seconds in trace_spans(trace).items():
+            spans[trace.hostname][stage].append(seconds)
+    return spans
+
+
+def print_summary(traces):
+    spans = summarize(traces)
+    print("{:<11} | {:<17} | {:>5} | {:>9} | {:>9} | {:>9} | {:>9}".format('Hostname', 'Stage', 'Files', 'mean', 'p50', 'p90', 'max'))
+    for hostname in sorted(spans):
+        for stage in SPANS:
+            values = spans[hostname][stage]
+            if not values:
+                continue
+            print("{:<11} | {:<17} | {:>5} | {:>7.1f} s | {:>7.1f} s | {:>7.1f} s | {:>7.1f} s".format(
+                hostname, stage, len(values), sum(values) / len(values), percentile(values, 50), percentile(values, 90), max(values)))
+
+
+def print_traces(traces):
+    for trace in traces:
+        spans = trace_spans(trace)
+        print("{} | {}".format(trace.file, ' | '.join('{} {:.1f} s'.format(stage, seconds) for stage, seconds in spans.items())))
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Shows where the stored files of the pull collector spent their time, from the traces in its job table.')
+    parser.add_argument('jobs_file', help='job table of the collector, e.g., tmp/jobs.sqlite')
+    parser.add_argument('--unit', default=None, help='hostname of a single unit, all units by default')
+    parser.add_argument('--since', type=float, default=24 * 60 * 60, help='seconds to look back')
+    parser.add_argument('--files', action='store_true', help='show each file instead of the summary')
+    args = parser.parse_args()
+
+    traces = JobTable(args.jobs_file).traces(hostname=args.unit, since=time.time() - args.since)
+    if args.files:
+        print_traces(traces)
+    else:
+        print_summary(traces)
+
+
+if __name__ == '__main__':
+    __main__()
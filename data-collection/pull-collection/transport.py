@@ -0,0 +1,205 @@
+import asyncio
+import os
+import re
+import shutil
+import time
+
+CONTROL_DIRECTORY = os.path.expanduser('~/.ssh/energy-daq')
+IDLE_TIMEOUT = 600  # seconds before an unused master connection is closed
+LIST_TIMEOUT = 15  # seconds
+RECONNECT_DELAYS = (30, 60, 90, 120, 180, 240, 300)  # seconds
+RECEIVED_PREFIX = 'received: '  # marks the files reported by rsync in its output, apart from its messages
+CONNECTION_ERRORS = re.compile('No route to host|Connection refused|Connection timed out|Connection reset|Could not resolve hostname|Network is unreachable')
+
+
+class TransportError(Exception):
+    """
+    A failed listing or transfer. Connection errors carry the number of seconds
+    to wait before the unit should be contacted again.
+    """
+
+    def __init__(self, message, retry_in=0):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+async def run_command(command, timeout=None, input=None):
+    """
+    Runs a command without blocking the event loop, and returns its exit code and output.
+    """
+    process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE if input is not None else None,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(input), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, output.decode('UTF-8', errors='replace')
+
+
+class SSHTransport(object):
+    """
+    Lists and receives the files of a unit with rsync over ssh. All ssh sessions to
+    a unit share one multiplexed master connection, so that polling a unit does not
+    pay for a key exchange every time. The master closes itself after IDLE_TIMEOUT
+    seconds without a session, and failed connections are retried with a backoff.
+    """
+
+    def __init__(self, unit, key_path, control_directory=CONTROL_DIRECTORY, idle_timeout=IDLE_TIMEOUT):
+        self.unit = unit
+        self.key_path = key_path
+        self.control_directory = control_directory
+        self.idle_timeout = idle_timeout
+        self.source = '{}@{}:/energy-daq/files/'.format(unit.username, unit.ip)
+        self.connection_error_count = 0
+        self.retry_at = 0
+
+    def _build_ssh_command(self):
+        return [
+            'ssh',
+            '-i', self.key_path,
+            '-T',
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'Compression=no',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}/%C'.format(self.control_directory),
+            '-o', 'ControlPersist={}'.format(self.idle_timeout),
+            '-o', 'ServerAliveInterval=15',
+        ]
+
+    def _build_rsync_command(self, bwlimit=None):
+        c = [
+            'rsync',
+            '--times',
+            '--archive',
+            '--no-perms',
+            '--no-group',
+            '--timeout=30',
+        ]
+        if bwlimit is not None:
+            c.append('--bwlimit={}'.format(bwlimit))
+        return c + ['-e', ' '.join(self._build_ssh_command())]
+
+    async def _rsync(self, arguments, bwlimit=None, timeout=None, input=None, check=True):
+        remaining = self.retry_at - time.time()
+        if remaining > 0:
+            raise TransportError('{} is unreachable, retrying in {:.0f} seconds'.format(self.unit.hostname, remaining), retry_in=remaining)
+
+        os.makedirs(self.control_directory, mode=0o700, exist_ok=True)
+        returncode, output = await run_command(self._build_rsync_command(bwlimit) + arguments, timeout=timeout, input=input)
+
+        if returncode != 0 and CONNECTION_ERRORS.search(output):
+            delay = RECONNECT_DELAYS[min(self.connection_error_count, len(RECONNECT_DELAYS) - 1)]
+            self.connection_error_count += 1
+            self.retry_at = time.time() + delay
+            raise TransportError(output.strip(), retry_in=delay)
+        self.connection_error_count = 0
+
+        if returncode != 0 and check:
+            raise TransportError('{}, {}'.format(returncode, output.strip() or "<no output>"))
+        return returncode, output
+
+    async def list_files(self, destination):
+        """
+        Returns the paths of all files on the unit relative to its files directory,
+        e.g., ram/unit-2016-06-04T22-24-42.411571+0200-0000001.hdf5.
+        """
+        try:
+            _, output = await self._rsync([
+                '--dry-run',
+                '--info=NAME1',
+                '--filter=include /ram',
+                '--filter=include /persisted',
+                '--filter=include **.hdf5',
+                '--filter=exclude *',
+                self.source,
+                destination,
+            ], timeout=LIST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TransportError('Could not get file list due to timeout.')
+
+        files = output.strip().split('\n')
+        return [file for file in files if file and file.endswith('.hdf5') and not file == './']
+
+    async def fetch_batch(self, files, output_directory, bwlimit=None):
+        """
+        Receives files into the output directory with a single rsync and removes them
+        from the unit. Returns the received files and the error, if any of the files
+        could not be received.
+        """
+        returncode, output = await self._rsync([
+            '--files-from=-',
+            '--no-relative',
+            '--partial-dir=.rsync-partial',
+            '--remove-source-files',
+            # with a transfer statistic such as %b, rsync reports each file after it was transferred
+            '--out-format={}%b %n'.format(RECEIVED_PREFIX),
+            self.source,
+            output_directory,
+        ], bwlimit=bwlimit, input='\n'.join(files).encode('UTF-8'), check=False)
+
+        # only the files rsync reports as transferred, an older copy in the output directory does not count
+        lines = output.split('\n')
+        reported = set(os.path.basename(line[len(RECEIVED_PREFIX):].split(' ', 1)[-1].strip()) for line in lines if line.startswith(RECEIVED_PREFIX))
+        received = [file for file in files if os.path.basename(file) in reported]
+        error = None
+        if returncode != 0:
+            messages = '\n'.join(line for line in lines if not line.startswith(RECEIVED_PREFIX)).strip()
+            error = '{}, {}'.format(returncode, messages or "<no output>")
+            if not received:
+                raise TransportError(error)
+        return received, error
+
+    async def close(self):
+        await run_command(self._build_ssh_command() + ['-O', 'exit', '{}@{}'.format(self.unit.username, self.unit.ip)])
+
+
+class LocalTransport(object):
+    """
+    Lists and receives the files of a unit from a local directory with the same
+    layout as /energy-daq/files on the unit, for running the collector without
+    real DAQ hosts. The bandwidth limit is emulated by delaying each transfer.
+    """
+
+    def __init__(self, unit, root):
+        self.unit = unit
+        self.root = root
+
+    async def list_files(self, destination):
+        files = []
+        for directory in ['ram', 'persisted']:
+            for path, _, names in os.walk(os.path.join(self.root, directory)):
+                files.extend(os.path.relpath(os.path.join(path, name), self.root) for name in names if name.endswith('.hdf5'))
+        return sorted(files)
+
+    async def fetch_batch(self, files, output_directory, bwlimit=None):
+        received = []
+        for file in files:
+            try:
+                await self._fetch(file, output_directory, bwlimit)
+            except TransportError as e:
+                if not received:
+                    raise
+                return received, str(e)
+            received.append(file)
+        return received, None
+
+    async def _fetch(self, file, output_directory, bwlimit):
+        src = os.path.join(self.root, file)
+        dst = os.path.join(output_directory, os.path.basename(file))
+        start_time = time.time()
+        try:
+            # copy to a hidden file and rename it, as rsync does
+            tmp = os.path.join(output_directory, '.{}.tmp'.format(os.path.basename(file)))
+            await asyncio.get_event_loop().run_in_executor(None, shutil.copyfile, src, tmp)
+            os.replace(tmp, dst)
+            os.remove(src)
+        except OSError as e:
+            raise TransportError(str(e))
+
+        if bwlimit:
+            await asyncio.sleep(max(os.path.getsize(dst) / (bwlimit * 1024) - (time.time() - start_time), 0))
+
+    async def close(self):
+        pass
@@ -1,36 +1,234 @@
 #!/usr/bin/env python3
 
-import os
 import glob
+import json
 import multiprocessing
+import os
+import queue
+import sys
 import time
 
-jobs = dict()
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# the converter is next to this directory in the repository, or in the same directory when deployed
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+INPUT_DIRECTORY = os.path.expanduser('/energy-daq/tmp')
+LEDGER_FILE = 'files/converter-ledger.json'
+COMPRESSION_PROFILE = os.environ.get('COMPRESSION_PROFILE', 'archive')
+CHUNK_LAYOUT = os.environ.get('CHUNK_LAYOUT', 'auto')
+POLL_INTERVAL = 10  # seconds, only used if inotify is not available
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60  # seconds, multiplied by the number of failed attempts
+DONE_RETENTION = 24 * 60 * 60  # seconds
+
+started = None  # queue of (file, attempt, pid) in the pool workers
 
 
-def convert(local_file):
+def init_worker(queue):
+    global started
+    started = queue
+
+
+def convert(local_file, attempt):
+    started.put((local_file, attempt, os.getpid()))
     import converter
     frequency = 50000 if 'medal' in local_file else 250000
-    c = converter.Converter(local_file, frequency)
+    c = converter.Converter(local_file, frequency, block_size=converter.STREAMING_BLOCK_SIZE, compression_profile=COMPRESSION_PROFILE, chunk_layout=CHUNK_LAYOUT)
     c.start()
     return local_file
 
 
-def cleanup(result):
-    del jobs[result]
-    print("cleanup: {}".format(result))
+class Ledger(object):
+    """
+    Persistent record of every input file and its conversion state:
+    pending, running, failed, or done. Results are matched to the attempt that
+    produced them, so that a result of an attempt that was given up is ignored.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+
+        for file, entry in self.entries.items():
+            if entry['state'] == 'running':
+                # the collector stopped during the conversion
+                entry['state'] = 'pending'
+        self._save()
+
+    def add(self, file):
+        if file in self.entries and self.entries[file]['state'] != 'done':
+            return
+        try:
+            mtime = os.path.getmtime(file)
+        except OSError:
+            return
+        print("pending: {}".format(file))
+        self.entries[file] = {'state': 'pending', 'mtime': mtime, 'attempts': 0, 'retry_at': 0, 'error': None}
+        self._save()
+
+    def next_pending(self, count):
+        """
+        Returns up to count pending files, the oldest first.
+        """
+        now = time.time()
+        pending = [file for file, entry in self.entries.items() if entry['state'] == 'pending' and entry['retry_at'] <= now]
+        return sorted(pending, key=lambda file: (self.entries[file]['mtime'], file))[:max(count, 0)]
+
+    def running(self):
+        return len([entry for entry in self.entries.values() if entry['state'] == 'running'])
+
+    def start(self, file):
+        print("activating: {}".format(file))
+        self.entries[file]['state'] = 'running'
+        self.entries[file]['attempts'] += 1
+        self.entries[file]['started_at'] = time.time()
+        self.entries[file]['pid'] = None
+        self._save()
+        return self.entries[file]['attempts']
+
+    def worker_started(self, file, attempt, pid):
+        entry = self.entries.get(file)
+        if entry is not None and entry['state'] == 'running' and entry['attempts'] == attempt:
+            entry['pid'] = pid
+
+    def expire(self, lost):
+        """
+        Finishes the conversions whose worker died as failed attempts, as the pool calls neither
+        callback then. lost(file, entry) tells whether a running conversion was lost.
+        """
+        for file, entry in list(self.entries.items()):
+            if entry['state'] == 'running' and entry.get('pid') is not None and lost(file, entry):
+                self.finish(file, RuntimeError("worker {} died".format(entry['pid'])), entry['attempts'])
+
+    def finish(self, file, error, attempt):
+        entry = self.entries.get(file)
+        if entry is None or entry['state'] != 'running' or entry['attempts'] != attempt:
+            print("ignoring: {} result of attempt {} that was given up".format(file, attempt))
+            return
+        if error is None:
+            print("cleanup: {}".format(file))
+            entry['state'] = 'done'
+            entry['done_at'] = time.time()
+        elif entry['attempts'] < MAX_ATTEMPTS:
+            print("retrying: {} after attempt {} failed: {!r}".format(file, entry['attempts'], error))
+            entry['state'] = 'pending'
+            entry['retry_at'] = time.time() + RETRY_DELAY * entry['attempts']
+            entry['error'] = repr(error)
+        else:
+            print("failed: {} after {} attempts: {!r}".format(file, entry['attempts'], error))
+            entry['state'] = 'failed'
+            entry['error'] = repr(error)
+        self._prune()
+        self._save()
+
+    def _prune(self):
+        now = time.time()
+        for file in [file for file, entry in self.entries.items() if entry['state'] == 'done' and entry['done_at'] < now - DONE_RETENTION]:
+            del self.entries[file]
+        for file in [file for file, entry in self.entries.items() if entry['state'] == 'pending' and not os.path.exists(file)]:
+            print("vanished: {}".format(file))
+            del self.entries[file]
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+class Watcher(object):
+    """
+    Reports completed uploads in the input directory. Uses inotify if available
+    and falls back to polling otherwise.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.inotify = None
+        self.last_poll = 0
+        if INotify is not None:
+            self.inotify = INotify()
+            # rsync moves a completed upload from a hidden temporary file to its final name
+            self.inotify.add_watch(self.directory, flags.MOVED_TO | flags.CLOSE_WRITE)
+        else:
+            print("inotify not available, polling every {} seconds".format(POLL_INTERVAL))
+
+    def existing(self):
+        return glob.glob(os.path.join(self.directory, '*.bin'))
+
+    def wait(self, timeout):
+        """
+        Returns the files completed within the next timeout seconds.
+        """
+        if self.inotify is None:
+            if time.time() - self.last_poll < POLL_INTERVAL:
+                time.sleep(timeout)
+                return []
+            self.last_poll = time.time()
+            return self.existing()
+
+        files = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                return self.existing()
+            if event.name.endswith('.bin') and not event.name.startswith('.'):
+                files.append(os.path.join(self.directory, event.name))
+        return files
+
+
+def worker_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
 
 
 def main():
-    pool = multiprocessing.Pool(os.cpu_count() - 1)
+    workers = max(os.cpu_count() - 1, 1)
+    # written synchronously, so that a worker that dies right after starting a conversion has reported it
+    started_queue = multiprocessing.SimpleQueue()
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(started_queue,))
+    results = queue.Queue()
+    tasks = {}  # file: AsyncResult of its running conversion
+
+    ledger = Ledger(LEDGER_FILE)
+    watcher = Watcher(INPUT_DIRECTORY)
+    for f in watcher.existing():
+        ledger.add(f)
+
+    def schedule(f):
+        attempt = ledger.start(f)
+        tasks[f] = pool.apply_async(convert, (f, attempt),
+                                    callback=lambda _: results.put((f, None, attempt)),
+                                    error_callback=lambda e: results.put((f, e, attempt)))
+
+    def lost(f, entry):
+        # the pool replaces a dead worker, but the conversion it ran never finishes
+        return f in tasks and not tasks[f].ready() and not worker_alive(entry['pid'])
+
     while True:
-        for f in glob.glob(os.path.expanduser('/energy-daq/tmp/*.bin')):
-            if f not in jobs.keys():
-                print("activating: {}".format(f))
-                jobs[f] = 'running'
-                pool.apply_async(convert, (f,), callback=cleanup)
-        print("sleeping...")
-        time.sleep(10)
+        for f in watcher.wait(timeout=1):
+            ledger.add(f)
+
+        while not results.empty():
+            ledger.finish(*results.get())
+        while not started_queue.empty():
+            ledger.worker_started(*started_queue.get())
+        ledger.expire(lost)
+
+        # keep only as many conversions in the pool as there are workers,
+        # so that the oldest pending file is always converted next
+        for f in ledger.next_pending(workers - ledger.running()):
+            schedule(f)
     pool.close()
 
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+
+import h5py
+import numpy
+
+import converter
+
+VERIFY_BLOCK_SIZE = 16 * 1024 * 1024  # samples per channel compared at once
+KEEP_CHUNKS = 'keep'  # chunk layout that keeps the chunk shape of the source file
+
+
+def find_files(root):
+    files = glob.glob(os.path.join(root, 'BLOND-50/**/*.hdf5'), recursive=True)
+    files += glob.glob(os.path.join(root, 'BLOND-250/**/*.hdf5'), recursive=True)
+    return sorted(os.path.relpath(f, root) for f in files if 'summary' not in os.path.basename(f))
+
+
+def _channel_names(f):
+    return [name for name in f if isinstance(f[name], h5py.Dataset)]
+
+
+def _rewrite(source, output_file, compression_profile, chunk_layout, add_aggregates):
+    for key, value in source.attrs.items():
+        output_file.attrs.create(key, value, dtype=source.attrs.get_id(key).dtype)
+
+    names = _channel_names(source)
+    add_aggregates = add_aggregates and converter.AGGREGATES_GROUP not in source
+
+    for name in names:
+        values = source[name][:]
+        if chunk_layout == KEEP_CHUNKS:
+            chunks = source[name].chunks
+        else:
+            chunks = converter.chunk_shape(chunk_layout, source.attrs['frequency'], len(values))
+        dset = output_file.create_dataset(name, data=values, chunks=chunks, **converter.COMPRESSION_PROFILES[compression_profile])
+        for key, value in source[name].attrs.items():
+            dset.attrs.create(key, value, dtype=source[name].attrs.get_id(key).dtype)
+
+        if add_aggregates:
+            aggregator = converter.SecondAggregator([name], len(values), int(source.attrs['frequency']))
+            aggregator.update(0, [values])
+            aggregator.write(output_file)
+
+    for name in source:
+        if name not in names:
+            source.copy(source[name], output_file, name)
+
+
+def _verify(source_file, output_file):
+    with h5py.File(source_file, 'r') as source, h5py.File(output_file, 'r') as output:
+        for key, value in source.attrs.items():
+            if not numpy.array_equal(value, output.attrs[key]):
+                raise ValueError('attribute {} differs'.format(key))
+
+        for name in _channel_names(source):
+            if source[name].shape != output[name].shape or source[name].dtype != output[name].dtype:
+                raise ValueError('{}: shape or type differs'.format(name))
+            for key, value in source[name].attrs.items():
+                if not numpy.array_equal(value, output[name].attrs[key]):
+                    raise ValueError('{}: attribute {} differs'.format(name, key))
+            for start in range(0, len(source[name]), VERIFY_BLOCK_SIZE):
+                end = start + VERIFY_BLOCK_SIZE
+                if not numpy.array_equal(source[name][start:end], output[name][start:end]):
+                    raise ValueError('{}: samples differ between {} and {}'.format(name, start, end))
+
+
+def reencode_file(file, root, compression_profile, chunk_layout, add_aggregates):
+    """
+    Rewrites a converted file with a new compression and chunk layout, or its current chunk shape
+    for KEEP_CHUNKS, verifies it sample by sample, and atomically replaces the original. Returns the file, the error if any,
+    the old and new file size, and the duration.
+    """
+    source_file = os.path.join(root, file)
+    output_file = source_file + '.reencoding'
+
+    try:
+        start_time = time.time()
+        with h5py.File(source_file, 'r') as source, h5py.File(output_file, 'w') as output:
+            _rewrite(source, output, compression_profile, chunk_layout, add_aggregates)
+        _verify(source_file, output_file)
+
+        size = os.path.getsize(source_file)
+        os.replace(output_file, source_file)
+        return file, None, size, os.path.getsize(source_file), time.time() - start_time
+    except Exception:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return file, traceback.format_exc(), 0, 0, 0
+
+
+def _journal_options(compression_profile, chunk_layout, add_aggregates):
+    return '{} {} {}'.format(compression_profile, chunk_layout, int(add_aggregates))
+
+
+def _load_journal(journal, options):
+    """
+    Returns the files completed with the given options, and the number of files
+    completed with other options, which are re-encoded again.
+    """
+    done = set()
+    other = 0
+    if not os.path.exists(journal):
+        return done, other
+    with open(journal, 'r') as f:
+        for line in f:
+            # compression profile, chunk layout, aggregates flag, file
+            parts = line.rstrip('\n').split(' ', 3)
+            if len(parts) < 4:
+                other += 1
+            elif ' '.join(parts[:3]) == options:
+                done.add(parts[3])
+            else:
+                other += 1
+    return done, other
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Re-encodes converted BLOND files in place, e.g., with a new compression profile.')
+    parser.add_argument('root', help='directory containing BLOND-50 and BLOND-250')
+    parser.add_argument('--compression', choices=sorted(converter.COMPRESSION_PROFILES), default=converter.DEFAULT_COMPRESSION_PROFILE)
+    parser.add_argument('--chunks', choices=sorted(converter.CHUNK_LAYOUTS) + [KEEP_CHUNKS], default=KEEP_CHUNKS,
+                        help='chunk layout, by default the chunk shape of each file is kept')
+    parser.add_argument('--add-aggregates', action='store_true', help='add per-second aggregates to files without them')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--journal', default='reencode.journal', help='completed files and their options, skipped when resuming with the same options')
+    args = parser.parse_args()
+
+    options = _journal_options(args.compression, args.chunks, args.add_aggregates)
+    done, other = _load_journal(args.journal, options)
+    files = [f for f in find_files(args.root) if f not in done]
+    print("Re-encoding {} files, {} already done...".format(len(files), len(done)))
+    if other:
+        print("Ignoring {} journal entries completed with other options than: {}".format(other, options))
+
+    failed = 0
+    reencode = functools.partial(reencode_file, root=args.root, compression_profile=args.compression, chunk_layout=args.chunks, add_aggregates=args.add_aggregates)
+    with multiprocessing.Pool(args.processes) as pool, open(args.journal, 'a') as journal:
+        for i, (file, error, old_size, new_size, time_elapsed) in enumerate(pool.imap_unordered(reencode, files), 1):
+            if error:
+                failed += 1
+                print("[{}/{}] Re-encoding {} failed:\n{}".format(i, len(files), file, error))
+                continue
+            journal.write('{} {}\n'.format(options, file))
+            journal.flush()
+            os.fsync(journal.fileno())
+            print("[{}/{}] Re-encoded {} in {:.1f} seconds from {} to {} bytes.".format(i, len(files), file, time_elapsed, old_size, new_size))
+
+    print("Done, {} files failed.".format(failed))
+
+
+if __name__ == '__main__':
+    __main__()
@@ -1,27 +1,106 @@
+import errno
 import os
 import hashlib
 import glob
+import shutil
 
-from rq import Queue
-from rq import get_current_job
+MANIFEST = 'checksums.manifest'  # one "digest size mtime name" line per file, later lines win
+CHECKS_SUFFIX = '.checks.json'  # technical validation results stored next to each file
+BLOCK_SIZE = 1024 * 1024
+
+
+def _sha512(file):
+    h = hashlib.sha512()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def move_with_checksum(src, dst):
+    """
+    Moves a file to the full destination path and returns its SHA-512 digest. A move
+    within the file system is a rename followed by reading the file, which is still in
+    the page cache; across file systems the digest is computed while copying.
+    """
+    try:
+        os.rename(src, dst)
+        return _sha512(dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    h = hashlib.sha512()
+    tmp = os.path.join(os.path.dirname(dst), '.{}.tmp'.format(os.path.basename(dst)))
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        for block in iter(lambda: fsrc.read(BLOCK_SIZE), b''):
+            h.update(block)
+            fdst.write(block)
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+    os.remove(src)
+    return h.hexdigest()
+
+
+def read_manifest(folder):
+    """
+    Returns the digest, size and mtime of each file in the manifest of a folder.
+    """
+    entries = {}
+    try:
+        with open(os.path.join(folder, MANIFEST), 'r') as f:
+            for line in f:
+                try:
+                    digest, size, mtime, name = line.rstrip('\n').split(' ', 3)
+                    entries[name] = (digest, int(size), float(mtime))
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+    except IOError:
+        pass
+    return entries
+
+
+def append_manifest(folder, name, digest):
+    st = os.stat(os.path.join(folder, name))
+    with open(os.path.join(folder, MANIFEST), 'a') as f:
+        f.write('{} {} {!r} {}\n'.format(digest, st.st_size, st.st_mtime, name))
+
+
+def list_files(files_path):
+    """
+    Returns the data files matching the pattern, without the manifest and the validation results,
+    which change whenever the checks do.
+    """
+    return [file for file in glob.glob(files_path) if os.path.basename(file) != MANIFEST and not file.endswith(CHECKS_SUFFIX)]
 
 
 def compute_checksum(folder, path_prefix):
     files_path = os.path.expanduser(os.path.join(path_prefix, folder, '*.*'))
-    files = glob.glob(files_path)
+    files = list_files(files_path)
     if len(files) == 0:
         raise ValueError("No files found: " + files_path)
 
+    # digests of files stored by the collector, unless the file changed since
+    manifest = read_manifest(os.path.dirname(files_path))
     checksums = []
 
     for file in files:
         try:
-            with open(file, 'rb') as f:
-                digest = hashlib.sha512(f.read()).hexdigest()
+            st = os.stat(file)
+            entry = manifest.get(os.path.basename(file))
+            if entry is not None and entry[1:] == (st.st_size, st.st_mtime):
+                digest = entry[0]
+            else:
+                digest = _sha512(file)
         except IOError:
             digest = 'ERROR'
         checksums.append((digest, os.path.relpath(file, os.path.expanduser(os.path.join(path_prefix)))))
 
+    # only needed when running as a job, so that the collector can use the functions without rq
+    from rq import Queue
+    from rq import get_current_job
+
     job = get_current_job()
     results_q = Queue(connection=job.connection, name='results')
     results_q.enqueue(print, checksums)
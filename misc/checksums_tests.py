@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from checksums_functions import *
+
+# %%
+# only the data files are checksummed, not the manifest or the validation results next to them
+with tempfile.TemporaryDirectory() as folder:
+    for name in ['clear-2017-06-12T11-10-55.327670T+0200-0022211.hdf5', 'clear-2017-06-12T11-10-55.327670T+0200-0022211.hdf5' + CHECKS_SUFFIX, MANIFEST]:
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(name)
+
+    files = list_files(os.path.join(folder, '*.*'))
+    assert [os.path.basename(file) for file in files] == ['clear-2017-06-12T11-10-55.327670T+0200-0022211.hdf5'], files
+
+print('SUCCESS')
@@ -10,7 +10,7 @@ import progressbar
 from redis import Redis
 from rq import Queue
 
-from per_file_data_checks_functions import check_file
+from per_file_data_checks_functions import check_file, read_results
 
 LOCAL_PATH_PREFIX = os.environ['LOCAL_PATH_PREFIX']
 WORKER_PATH_PREFIX = os.environ['WORKER_PATH_PREFIX']
@@ -42,6 +42,20 @@ if __name__ == '__main__':
     files += glob.glob(os.path.join(LOCAL_PATH_PREFIX, 'BLOND-250/**/*.hdf5'), recursive=True)
     files = [os.path.relpath(d, LOCAL_PATH_PREFIX) for d in files if 'summary' not in os.path.basename(d)]
 
+    # files validated by the collector at ingest are not read again
+    validated = 0
+    remaining = []
+    for file in files:
+        fails = read_results(os.path.join(LOCAL_PATH_PREFIX, file))
+        if fails is None:
+            remaining.append(file)
+            continue
+        validated += 1
+        for fail in fails:
+            print('{}: {}'.format(file, fail), file=sys.stderr)
+    print("Skipping {} files already validated.".format(validated))
+    files = remaining
+
     total_jobs = len(files)
     done_jobs = 0
 
@@ -1,4 +1,6 @@
+import json
 import os
+import time
 import traceback
 import sys
 
@@ -6,8 +8,10 @@ import h5py
 import numpy
 import numpy as np
 
-from rq import Queue
-from rq import get_current_job
+
+def channel_names(f):
+    # converted files may contain groups with metadata next to the channels
+    return [name for name in f if isinstance(f[name], h5py.Dataset)]
 
 
 def check_dataset_length(f):
@@ -31,13 +35,13 @@ def check_dataset_length(f):
         else:
             raise ValueError('Dataset length unknown: {}'.format(frequency))
 
-    for name in list(f):
+    for name in channel_names(f):
         if len(f[name]) != expected_length:
             raise ValueError('{}: Dataset length is {}, expected to be {}'.format(name, len(f[name]), expected_length))
 
 
 def check_mains_frequency(f):
-    dsets = [n for n in list(f) if 'voltage' in n]
+    dsets = [n for n in channel_names(f) if 'voltage' in n]
     for name in dsets:
         frequency = int(f.attrs['frequency'])
         voltage_signal = f[name][:] * f[name].attrs['calibration_factor']
@@ -51,7 +55,7 @@ def check_mains_frequency(f):
 
 
 def check_voltage_rms(f):
-    dsets = [n for n in list(f) if 'voltage' in n]
+    dsets = [n for n in channel_names(f) if 'voltage' in n]
     for name in dsets:
         s = f[name][:] * f[name].attrs['calibration_factor']
         rms = numpy.sqrt(numpy.mean(numpy.square(s)))
@@ -73,7 +77,7 @@ def check_voltage_values(f):
         # MEDAL uses 12-bit unsigned integers with DC-offset
         threshold = 2000
 
-    dsets = [n for n in list(f) if 'voltage' in n]
+    dsets = [n for n in channel_names(f) if 'voltage' in n]
     for name in dsets:
         s = f[name][:]
         used_values = len(numpy.unique(s))
@@ -91,7 +95,7 @@ def check_voltage_bandwidth(f):
         threshold = 50
         bits = 12
 
-    dsets = [n for n in list(f) if 'voltage' in n]
+    dsets = [n for n in channel_names(f) if 'voltage' in n]
     for name in dsets:
         s = f[name][:]
         calibration_factor = f[name].attrs['calibration_factor']
@@ -115,7 +119,7 @@ def check_current_rms(f):
         threshold = 16
 
     frequency = int(f.attrs['frequency'])
-    dsets = [n for n in list(f) if 'current' in n]
+    dsets = [n for n in channel_names(f) if 'current' in n]
     for name in dsets:
         s = f[name][:] * f[name].attrs['calibration_factor']
         rms = numpy.max(numpy.sqrt(numpy.mean(numpy.square(s).reshape(-1, frequency), axis=1)))
@@ -129,42 +133,129 @@ def check_current_rms(f):
             raise ValueError('{}: crest factor is {}, expected to be >= 1.2'.format(name, crest_factor))
 
 
+def find_flat_runs(signal, min_length):
+    """
+    Returns the start indices and lengths of all runs of at least min_length equal consecutive samples.
+    """
+    signal = np.asarray(signal)
+    if len(signal) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # a run starts at the first sample and wherever the value changes
+    starts = np.concatenate(([0], np.flatnonzero(signal[1:] != signal[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(signal)))
+    long_runs = lengths >= min_length
+    return starts[long_runs], lengths[long_runs]
+
+
 def check_flat_regions(f):
     frequency = int(f.attrs['frequency'])
-    for name in list(f):
+    for name in channel_names(f):
         s = f[name][:]
+        if len(s) == 0:
+            continue
         step = int(frequency / 50)
-        for x in range(0, len(s), step):
-            value = np.sum(np.abs(np.diff(s[x:x + step])))
-            if value == 0:
-                raise ValueError('{}: flat region found at index: {}'.format(name, step))
+
+        # a 20 ms window is flat if it lies within a single run, the last window can be shorter
+        last_window = (len(s) - 1) % step + 1
+        starts, lengths = find_flat_runs(s, min(step, last_window))
+        windows = -(-starts // step) * step  # first window starting within each run
+        flat = (windows < len(s)) & (np.minimum(windows + step, len(s)) <= starts + lengths)
+        if np.any(flat):
+            raise ValueError('{}: flat region found at index: {}'.format(name, windows[flat][0]))
+
+
+def check_dropped_packets(f):
+    # the trigger gap index is only available in files converted with it
+    dropped_packets = f.attrs.get('dropped_packets')
+    if dropped_packets is not None and dropped_packets > 0:
+        raise ValueError('{} packets dropped, expected to be 0'.format(dropped_packets))
+
+
+CHECKS = [
+    check_dataset_length,
+    check_mains_frequency,
+    check_voltage_rms,
+    check_voltage_values,
+    check_voltage_bandwidth,
+    check_current_rms,
+    check_flat_regions,
+    check_dropped_packets,
+]
+
+# increase whenever a check changes, so that files validated with older checks are validated again
+CHECKS_VERSION = 1
+
+
+def run_checks(f):
+    """
+    Runs all checks on an open file and returns the failures.
+    """
+    fails = []
+    for check in CHECKS:
+        try:
+            check(f)
+        except ValueError as e:
+            fails.append(e)
+        except Exception as e:
+            fails.append('{} | {} | {}'.format(repr(e), traceback.format_exc(), traceback.format_stack()))
+    return fails
+
+
+def results_filename(file):
+    return file + '.checks.json'
+
+
+def write_results(file, fails):
+    """
+    Stores the failures of a file in a sidecar file next to it, together with the
+    check version and the file size and modification time they apply to.
+    """
+    st = os.stat(file)
+    results = {
+        'version': CHECKS_VERSION,
+        'size': st.st_size,
+        # kept by the move into the storage, changed by rewriting the file in place
+        'mtime_ns': st.st_mtime_ns,
+        'checked_at': time.time(),
+        'fails': [str(fail) for fail in fails],
+    }
+    tmp = results_filename(file) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(results, f)
+    os.replace(tmp, results_filename(file))
+
+
+def read_results(file):
+    """
+    Returns the stored failures of a file, or None if it was not validated with the
+    current checks or has changed since.
+    """
+    try:
+        with open(results_filename(file), 'r') as f:
+            results = json.load(f)
+        st = os.stat(file)
+        if results['version'] == CHECKS_VERSION and results['size'] == st.st_size and results['mtime_ns'] == st.st_mtime_ns:
+            return results['fails']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
 
 
 def check_file(file, path_prefix):
     fails = []
-    checks = [
-        check_dataset_length,
-        check_mains_frequency,
-        check_voltage_rms,
-        check_voltage_values,
-        check_voltage_bandwidth,
-        check_current_rms,
-        check_flat_regions,
-    ]
 
     try:
         local_file = os.path.expanduser(os.path.join(path_prefix, file))
         with h5py.File(local_file, 'r', driver='core') as f:
-            for check in checks:
-                try:
-                    check(f)
-                except ValueError as e:
-                    fails.append(e)
-                except Exception as e:
-                    fails.append('{} | {} | {}'.format(repr(e), traceback.format_exc(), traceback.format_stack()))
+            fails = run_checks(f)
     except IOError as e:
         fails.append(ValueError(repr(e)))
 
+    # only needed when running as a job, so that the collector can use the checks without rq
+    from rq import Queue
+    from rq import get_current_job
+
     job = get_current_job()
     results_q = Queue(connection=job.connection, name='results')
 
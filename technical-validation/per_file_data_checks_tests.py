@@ -11,6 +11,7 @@ import numpy as np
 import h5py
 import os
 import glob
+import tempfile
 import traceback
 import matplotlib
 import matplotlib.mlab
@@ -28,6 +29,7 @@ checks = {
     'voltage_bandwidth': check_voltage_bandwidth,
     'current_rms': check_current_rms,
     'flat_regions': check_flat_regions,
+    'dropped_packets': check_dropped_packets,
 }
 
 for check_name, check_func in checks.items():
@@ -197,3 +199,70 @@ for file in files:
         for n in list(f):
             length = len(f[n])
             f[n][int(length / 2):int(length / 2 + frequency * 2)] = 2000
+
+# %%
+os.makedirs('file-checks-test-data/dropped_packets', exist_ok=True)
+shutil.copy('file-checks-test-data/BLOND-50-clear-2016-10-02T00-02-44.043307T+0200-0000443.hdf5', 'file-checks-test-data/dropped_packets/')
+shutil.copy('file-checks-test-data/BLOND-50-medal-1-2016-10-02T00-02-09.962358T+0200-0000148.hdf5', 'file-checks-test-data/dropped_packets/')
+
+files = glob.glob('file-checks-test-data/dropped_packets/*.hdf5')
+for file in files:
+    with h5py.File(file, 'r+') as f:
+        f.attrs.create('dropped_packets', 42, dtype='uint64')
+
+# %%
+# find_flat_runs must give the same verdicts as the loops it replaced
+def legacy_flat_regions(s, step):
+    for x in range(0, len(s), step):
+        if np.sum(np.abs(np.diff(s[x:x + step]))) == 0:
+            return True
+    return False
+
+def legacy_verification(values, threshold=500):
+    count = 0
+    idx_zeros = (np.diff(values) == 0).nonzero()[0]
+    for i in range(idx_zeros.size - 1):
+        if idx_zeros[i + 1] - idx_zeros[i] == 1:
+            count += 1
+            if count == threshold:
+                return False
+        else:
+            count = 0
+    return True
+
+random = np.random.RandomState(42)
+for i in range(500):
+    frequency = random.choice([6400, 50000])
+    step = int(frequency / 50)
+    s = random.randint(-1000, 1000, size=random.randint(1, 5 * step)).astype('i2')
+    for _ in range(random.randint(0, 3)):
+        start = random.randint(0, len(s))
+        s[start:start + random.choice([step - 1, step, step + 1, 501, 502, 503, random.randint(1, 2 * step)])] = random.randint(-2, 2)
+
+    with h5py.File('flat-regions-{}.hdf5'.format(i), 'w', driver='core', backing_store=False) as f:
+        f.attrs['frequency'] = frequency
+        f.create_dataset('channel', data=s)
+        try:
+            check_flat_regions(f)
+            flat = False
+        except ValueError:
+            flat = True
+    assert flat == legacy_flat_regions(s, step), i
+    assert (len(find_flat_runs(s, 502)[0]) == 0) == legacy_verification(s), i
+
+print('SUCCESS')
+
+# %%
+# stored results only apply to the file as it was checked, also if it is rewritten with the same size
+with tempfile.TemporaryDirectory() as directory:
+    file = os.path.join(directory, 'results.hdf5')
+    with open(file, 'wb') as f:
+        f.write(b'\0' * 1024)
+    write_results(file, [ValueError('fail')])
+    assert read_results(file) == ['fail']
+
+    st = os.stat(file)
+    os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert read_results(file) is None
+
+print('SUCCESS')